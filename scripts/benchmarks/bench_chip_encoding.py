@@ -0,0 +1,107 @@
+"""
+Benchmark of the chip encodings (see utils/chip_encoding.py): encode and
+decode throughput and chip size for every compression codec and block size.
+
+Non-empty tiles of a synthetic raster (see synthetic.py) are encoded with
+each profile the way make_chips does, and decoded the way process_chips
+does; every decoded chip is checked against its tile. From the time and
+size per chip, the time to encode, upload, download and decode a chip is
+estimated for each --bandwidth given, so the profile that is fastest end to
+end on a given network and CPU can be picked. The estimate assumes one core
+and the full bandwidth per chip, as a single chipping worker would see.
+
+Usage:
+    python scripts/benchmarks/bench_chip_encoding.py [--tiles 24] [--bandwidth 100 1000]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "core"))
+sys.path.insert(0, BENCH_DIR)
+
+
+def sample_tiles(src, count):
+    """The first count non-empty tiles of the raster, with their transforms."""
+    from utils.make_chips import TileReader
+
+    tiles = []
+    for _, transform, tile in TileReader(src):
+        tiles.append((tile.copy(), transform))
+        if len(tiles) == count:
+            break
+    return tiles
+
+
+def measure(src, tiles, encoding):
+    """Seconds to encode and decode the tiles, and the total size of the chips."""
+    import numpy as np
+    from rasterio.io import MemoryFile
+
+    from utils.make_chips import TileEncoder
+
+    encoder = TileEncoder(src, encoding=encoding)
+    start = time.perf_counter()
+    chips = [encoder.encode(tile, transform) for tile, transform in tiles]
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    arrays = []
+    for data in chips:
+        with MemoryFile(data) as memfile:
+            with memfile.open(driver="GTiff") as chip:
+                arrays.append(chip.read())
+    decode_seconds = time.perf_counter() - start
+
+    for (tile, _), array in zip(tiles, arrays):
+        if not np.array_equal(tile, array):
+            raise AssertionError(f"{encoding.name} chips don't decode to their tiles")
+    return encode_seconds, decode_seconds, sum(len(data) for data in chips)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument("--height", type=int, default=3072)
+    parser.add_argument("--nodata-fraction", type=float, default=0.3)
+    parser.add_argument("--tiles", type=int, default=24, help="Chips encoded per profile")
+    parser.add_argument("--bandwidth", type=float, nargs="+", default=[100, 1000], help="Network bandwidths to estimate end-to-end time for, in Mbit/s")
+    args = parser.parse_args()
+
+    import rasterio
+
+    from synthetic import write_synthetic_raster
+    from utils.chip_encoding import PROFILES
+
+    with tempfile.TemporaryDirectory(prefix="bench_chip_encoding_") as workdir:
+        path = write_synthetic_raster(
+            os.path.join(workdir, "raster.tif"), args.width, args.height, args.nodata_fraction
+        )
+        with rasterio.open(path) as src:
+            tiles = sample_tiles(src, args.tiles)
+            raw_mb = sum(tile.nbytes for tile, _ in tiles) / 1e6
+            results = [(encoding, *measure(src, tiles, encoding)) for encoding in PROFILES]
+
+    count = len(tiles)
+    header = f"{'profile':>16} {'MB/chip':>8} {'ratio':>6} {'encode MB/s':>12} {'decode MB/s':>12}"
+    header += "".join(f" {f'ms/chip @{bandwidth:g}':>14}" for bandwidth in args.bandwidth)
+    print(f"{count} chips, {raw_mb / count:.2f} MB each uncompressed; end-to-end is encode + upload + download + decode")
+    print(header)
+    for encoding, encode_seconds, decode_seconds, nbytes in results:
+        chip_mb = nbytes / 1e6 / count
+        line = (
+            f"{encoding.name:>16} {chip_mb:8.2f} {raw_mb * 1e6 / nbytes:6.2f} "
+            f"{raw_mb / encode_seconds:12.1f} {raw_mb / decode_seconds:12.1f}"
+        )
+        for bandwidth in args.bandwidth:
+            transfer_seconds = 2 * nbytes * 8 / (bandwidth * 1e6)
+            line += f" {(encode_seconds + decode_seconds + transfer_seconds) / count * 1000:14.1f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Offline benchmarks for the chip path: get_tiles, make_chips and process_chips
+(in memory and streaming).
+
+Synthetic rasters shaped like the Earth Engine exports (see synthetic.py) are
+written to a LocalBucket in a temporary directory, so no network or
+credentials are needed. Every stage of every case runs in a fresh process so
+its peak RSS is measured on its own. Results are saved as JSON under
+scripts/benchmarks/results/, named after the current commit, and can be
+compared against an earlier file.
+
+Usage:
+    python scripts/benchmarks/bench_chips.py [--cases small coastal] [--repeat 1]
+    python scripts/benchmarks/bench_chips.py --compare scripts/benchmarks/results/<commit>.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORE_DIR = os.path.join(BENCH_DIR, "..", "core")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+sys.path.insert(0, CORE_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+BUCKET_NAME = "bench"
+RAW_PREFIX = "raw/bench"
+CHIPS_PREFIX = "chips/bench"
+PROCESSED_PREFIX = "processed/bench"
+
+# name: (width, height, nodata fraction, flood fraction)
+CASES = {
+    "small": (2048, 2048, 0.3, 0.02),
+    "coastal": (4096, 3072, 0.7, 0.01),
+    "inland": (4096, 3072, 0.05, 0.03),
+    "country": (10240, 8192, 0.4, 0.02),
+}
+DEFAULT_CASES = ["small", "coastal", "inland"]
+
+STAGES = ["get_tiles", "make_chips", "process_chips", "process_chips_streaming"]
+
+# Metrics where a higher value is better; for everything else lower is better
+HIGHER_IS_BETTER = {"items_per_s", "mb_per_s"}
+
+
+def peak_rss_mb():
+    # VmHWM belongs to the current address space; ru_maxrss on Linux also
+    # carries over the parent's peak across fork and exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def prefix_size(bucket, prefix):
+    blobs = bucket.list_blobs(prefix=prefix)
+    return len(blobs), sum(blob.size for blob in blobs)
+
+
+def chips_size(bucket, prefix):
+    """
+    Number and total size of the chips under prefix, stored as GeoTIFF
+    objects or in shards. The tile plan, source records and statistics kept
+    next to them are left out.
+    """
+    from utils.chip_shards import SHARD_SUFFIX, is_shard_index, read_index
+
+    count = nbytes = 0
+    for blob in bucket.list_blobs(prefix=prefix):
+        if blob.name.endswith(".tif"):
+            count += 1
+            nbytes += blob.size
+        elif blob.name.endswith(SHARD_SUFFIX):
+            nbytes += blob.size
+        elif is_shard_index(blob):
+            count += len(read_index(blob))
+    return count, nbytes
+
+
+def step_items(report, step):
+    """Items recorded under a step of the run report, e.g. the chips decoded."""
+    return sum(row["items"] for row in report.rows() if row["step"] == step)
+
+
+def run_stage(root, stage):
+    """Run one stage against the local bucket. Executed in a fresh process."""
+    from utils.make_chips import get_tiles, make_chips
+    from utils.process_chips import process_chips
+    from utils.run_report import report
+    from utils.storage_backend import LocalBucket, open_raster
+
+    bucket = LocalBucket(root, BUCKET_NAME)
+    result = {"stage": stage}
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(io.StringIO()), report.scope("bench", stage):
+        if stage == "get_tiles":
+            items = 0
+            for blob in bucket.list_blobs(prefix=RAW_PREFIX):
+                with open_raster(blob) as src:
+                    items += sum(1 for _ in get_tiles(src))
+            result["items"] = items
+        elif stage == "make_chips":
+            make_chips(bucket, RAW_PREFIX, CHIPS_PREFIX)
+            result["items"], result["output_bytes"] = chips_size(bucket, CHIPS_PREFIX)
+        elif stage in ("process_chips", "process_chips_streaming"):
+            process_chips(bucket, CHIPS_PREFIX, PROCESSED_PREFIX, streaming=stage == "process_chips_streaming")
+            # Chips that the statistics show to have no floods aren't read
+            result["items"] = step_items(report, "decode")
+            result["output_bytes"] = prefix_size(bucket, PROCESSED_PREFIX)[1]
+
+    result["seconds"] = time.perf_counter() - start
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["steps"] = report.rows()
+    return result
+
+
+def run_case(name, repeat, workdir):
+    from synthetic import write_synthetic_raster
+    from utils.storage_backend import LocalBucket
+
+    width, height, nodata_fraction, flood_fraction = CASES[name]
+    root = os.path.join(workdir, name)
+    bucket = LocalBucket(root, BUCKET_NAME)
+    raw_path = bucket.blob(f"{RAW_PREFIX}_input_data_2020-01-01.tif").path
+    os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+    write_synthetic_raster(raw_path, width, height, nodata_fraction, flood_fraction)
+    input_bytes = os.path.getsize(raw_path)
+
+    stages = {}
+    context = multiprocessing.get_context("spawn")
+    for stage in STAGES:
+        best = None
+        for _ in range(repeat):
+            if stage == "make_chips":
+                # Start every repetition from an empty chip prefix
+                shutil.rmtree(os.path.join(bucket.path, CHIPS_PREFIX.split("/")[0]), ignore_errors=True)
+            with context.Pool(1) as pool:
+                result = pool.apply(run_stage, (root, stage))
+            if best is None or result["seconds"] < best["seconds"]:
+                best = result
+        seconds = best["seconds"]
+        best["items_per_s"] = best["items"] / seconds if seconds else None
+        moved = input_bytes if not stage.startswith("process_chips") else chips_size(bucket, CHIPS_PREFIX)[1]
+        best["mb_per_s"] = moved / 1e6 / seconds if seconds else None
+        stages[stage] = best
+        print(
+            f"{name:>8} {stage:<23} {seconds:8.2f} s  {best['items']:>7} items  "
+            f"{best['items_per_s'] or 0:9.1f} items/s  {best['mb_per_s'] or 0:8.1f} MB/s  "
+            f"peak RSS {best['peak_rss_mb']:8.1f} MB  output {best.get('output_bytes', 0) / 1e6:8.1f} MB"
+        )
+
+    shutil.rmtree(root, ignore_errors=True)
+    return {
+        "width": width,
+        "height": height,
+        "nodata_fraction": nodata_fraction,
+        "flood_fraction": flood_fraction,
+        "input_bytes": input_bytes,
+        "stages": stages,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=BENCH_DIR,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nChange relative to {baseline['revision']} ({baseline_path}):")
+    for case, case_result in current["cases"].items():
+        if case not in baseline["cases"]:
+            continue
+        for stage, result in case_result["stages"].items():
+            before = baseline["cases"][case]["stages"].get(stage)
+            if before is None:
+                continue
+            changes = []
+            for metric in ["seconds", "items_per_s", "mb_per_s", "peak_rss_mb", "output_bytes"]:
+                old, new = before.get(metric), result.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old * 100
+                better = change > 0 if metric in HIGHER_IS_BETTER else change < 0
+                marker = "" if abs(change) < 5 else (" (better)" if better else " (WORSE)")
+                changes.append(f"{metric} {change:+.1f}%{marker}")
+            print(f"{case:>8} {stage:<14} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=DEFAULT_CASES)
+    parser.add_argument("--repeat", type=int, default=1, help="Repetitions per stage; the fastest is kept")
+    parser.add_argument("--workdir", default=None, help="Directory for the temporary local buckets")
+    parser.add_argument("--output", default=None, help="Result file (default results/<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier result file to compare against")
+    args = parser.parse_args()
+
+    import numpy as np
+    import rasterio
+
+    revision = git_revision()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_chips_")
+    results = {
+        "revision": revision,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "cpu_count": os.cpu_count(),
+        "cases": {},
+    }
+    try:
+        for case in args.cases:
+            results["cases"][case] = run_case(case, args.repeat, workdir)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"chips-{revision}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Microbenchmark of the make_chips tile loop: time and memory allocated per tile.
+
+A synthetic raster (see synthetic.py) is read tile by tile with TileReader
+and each tile is encoded with TileEncoder, under tracemalloc. For every tile
+the peak of memory allocated on top of what was live before it is recorded,
+so buffers that are reused don't count and per-tile temporaries do. Pass
+--reference to also run the original loop (boundless read, np.pad, a full
+boolean comparison, a metadata copy per tile) for comparison. Uploads are
+not part of the loop measured here.
+
+Usage:
+    python scripts/benchmarks/bench_tile_loop.py [--width 4096 --height 3072] [--reference]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "core"))
+sys.path.insert(0, BENCH_DIR)
+
+
+def reference_tiles(src):
+    """The tile loop as it was before TileReader, yielding (window, transform, tile)."""
+    import numpy as np
+
+    from utils.make_chips import get_tiles
+
+    for window, transform in get_tiles(src):
+        tile = src.read(window=window, boundless=True, fill_value=0)
+        padded_tile = np.pad(tile, ((0, 0), (0, 512 - window.height), (0, 512 - window.width)), mode='constant', constant_values=0)
+        if np.any(padded_tile != 0):
+            yield window, transform, padded_tile
+
+
+def reference_encode(src, tile, transform):
+    from rasterio.io import MemoryFile
+
+    meta = src.meta.copy()
+    meta.update({"driver": "GTiff", "height": 512, "width": 512, "transform": transform})
+    with MemoryFile() as tile_memfile:
+        with tile_memfile.open(**meta) as tile_dst:
+            tile_dst.write(tile)
+        return tile_memfile.read()
+
+
+def measure(name, tiles, encode):
+    """Run the loop under tracemalloc, measuring the read and encode of every tile."""
+    read_peaks, encode_peaks, encoded_bytes = [], [], []
+    tracemalloc.start()
+    start = time.perf_counter()
+    iterator = iter(tiles)
+    while True:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        item = next(iterator, None)
+        if item is None:
+            break
+        read_peaks.append(tracemalloc.get_traced_memory()[1] - before)
+
+        window, transform, tile = item
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        data = encode(tile, transform)
+        encode_peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        encoded_bytes.append(len(data))
+        del data
+    seconds = time.perf_counter() - start
+    tracemalloc.stop()
+
+    count = len(read_peaks)
+    # The median is the steady state; the max includes one-off buffer allocations
+    median = lambda values: sorted(values)[len(values) // 2] / 1e6 if values else 0
+    tile_mb = 16 * 512 * 512 * 2 / 1e6
+    print(
+        f"{name:>10}: {count} tiles, {seconds / max(count, 1) * 1000:7.2f} ms/tile, "
+        f"read+check median {median(read_peaks):6.2f} MB/tile (max {max(read_peaks, default=0) / 1e6:.2f}), "
+        f"encode median {median(encode_peaks):6.2f} MB/tile, "
+        f"of which output {median(encoded_bytes):.2f} MB; one tile is {tile_mb:.2f} MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--width", type=int, default=4096)
+    parser.add_argument("--height", type=int, default=3072)
+    parser.add_argument("--nodata-fraction", type=float, default=0.3)
+    parser.add_argument("--reference", action="store_true", help="Also measure the original tile loop")
+    args = parser.parse_args()
+
+    import rasterio
+
+    from synthetic import write_synthetic_raster
+    from utils.make_chips import TileEncoder, TileReader
+
+    with tempfile.TemporaryDirectory(prefix="bench_tile_loop_") as workdir:
+        path = write_synthetic_raster(
+            os.path.join(workdir, "raster.tif"), args.width, args.height, args.nodata_fraction
+        )
+        with rasterio.open(path) as src:
+            encoder = TileEncoder(src)
+            measure("TileReader", TileReader(src), encoder.encode)
+            if args.reference:
+                measure(
+                    "reference",
+                    reference_tiles(src),
+                    lambda tile, transform: reference_encode(src, tile, transform),
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Resume checks for the run manifest and run_checkpointed.
+
+Replays stage outcomes against a throwaway manifest and checks that
+- a stage that raised is retried, and recorded as done by the next run that
+  succeeds (export included, whose per-event failures keep it open),
+- an export with a failed event stays open until the event succeeds,
+- a finished stage is skipped on the next run, and
+- a stage that overwrites another's output (fused and process) makes that
+  stage run again the next time.
+
+Usage:
+    python scripts/benchmarks/check_manifest.py
+
+Exits with a non-zero status when a check fails.
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+
+
+def fail():
+    raise RuntimeError("stage failed")
+
+
+def check_failed_stage_recovers(manifest, run_checkpointed, stage):
+    """A stage that raised once is done after the next successful run."""
+    try:
+        run_checkpointed(manifest, "Chad", stage, "fp1", fail)
+    except RuntimeError:
+        pass
+    for _ in range(3):
+        run_checkpointed(manifest, "Chad", stage, "fp1", lambda: None)
+    return manifest.is_done("Chad", stage, "fp1")
+
+
+def check_failed_event_keeps_export_open(manifest, run_checkpointed):
+    """An export with a failed event is retried until the event succeeds."""
+    from utils.run_manifest import FAILED
+
+    manifest.record("Mali", "export", "event-fp", FAILED, event="event-1")
+    run_checkpointed(manifest, "Mali", "export", "fp1", lambda: None)
+    still_open = not manifest.is_done("Mali", "export", "fp1")
+    manifest.record("Mali", "export", "event-fp", event="event-1")
+    run_checkpointed(manifest, "Mali", "export", "fp1", lambda: None)
+    return still_open and manifest.is_done("Mali", "export", "fp1")
+
+
+def check_done_stage_skipped(manifest, run_checkpointed):
+    """A finished stage is not run again with the same fingerprint."""
+    run_checkpointed(manifest, "Niger", "chips", "fp1", lambda: None)
+    calls = []
+    run_checkpointed(manifest, "Niger", "chips", "fp1", lambda: calls.append(1))
+    return not calls
+
+
+def check_replaced_stage_reruns(manifest, run_checkpointed):
+    """Processing runs again after a fused run has overwritten its output."""
+    run_checkpointed(manifest, "Togo", "process", "fp1", lambda: None, replaces=["fused"])
+    run_checkpointed(manifest, "Togo", "fused", "fp2", lambda: None, replaces=["process"])
+    calls = []
+    run_checkpointed(manifest, "Togo", "process", "fp1", lambda: calls.append(1), replaces=["fused"])
+    return bool(calls) and not manifest.is_done("Togo", "fused", "fp2")
+
+
+def main():
+    from main import run_checkpointed
+    from utils.run_manifest import RunManifest
+
+    with tempfile.TemporaryDirectory(prefix="check_manifest_") as workdir:
+        manifest = RunManifest(os.path.join(workdir, "run_manifest.sqlite"))
+        checks = {
+            "failed export recovers": check_failed_stage_recovers(manifest, run_checkpointed, "export"),
+            "failed chips recovers": check_failed_stage_recovers(manifest, run_checkpointed, "chips"),
+            "failed event keeps export open": check_failed_event_keeps_export_open(manifest, run_checkpointed),
+            "done stage skipped": check_done_stage_skipped(manifest, run_checkpointed),
+            "replaced stage reruns": check_replaced_stage_reruns(manifest, run_checkpointed),
+        }
+
+    failed = [name for name, ok in checks.items() if not ok]
+    for name in failed:
+        print(f"FAIL: {name}")
+    if not failed:
+        print("OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
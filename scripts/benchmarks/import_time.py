@@ -0,0 +1,109 @@
+"""
+Import-time budget for the pipeline entry point.
+
+Runs `python -X importtime scripts/core/main.py --help` a few times and
+checks that
+- no heavy dependency (Earth Engine, rasterio, numpy, pandas, the GCS client,
+  the country name table, ...) is imported just to start the CLI, and
+- the cumulative import time of the modules main.py pulls in stays within
+  the budget.
+
+Worker processes spawned by --cpu-workers re-import main.py, so this is paid
+once per worker as well as once per invocation.
+
+Usage:
+    python scripts/benchmarks/import_time.py [--budget-ms 150] [--runs 5]
+
+Exits with a non-zero status when the budget is exceeded.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+MAIN_PATH = os.path.join(os.path.dirname(__file__), "..", "core", "main.py")
+
+BUDGET_MS = 150
+
+# Modules that must only be imported by the stage that needs them
+HEAVY_MODULES = [
+    "ee",
+    "rasterio",
+    "numpy",
+    "pandas",
+    "sklearn",
+    "google.cloud.storage",
+    "fuzzywuzzy",
+    "requests_cache",
+    "pretty_errors",
+    "utils.countries_iso_dict",
+    "utils.make_raw_dat",
+    "utils.make_chips",
+    "utils.process_chips",
+]
+
+# Imported by the interpreter itself before main.py runs
+INTERPRETER_MODULES = ["site", "encodings", "_frozen_importlib_external"]
+
+
+def parse_importtime(stderr):
+    """
+    Returns (imported module names, cumulative microseconds of the top-level
+    imports made on behalf of main.py).
+    """
+    modules = set()
+    total_us = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.add(name.strip())
+        # Top-level imports are not indented; nested ones are already
+        # included in their parent's cumulative time
+        if not name.startswith("  ") and name.strip() not in INTERPRETER_MODULES:
+            total_us += int(cumulative)
+    return modules, total_us
+
+
+def measure(runs):
+    timings = []
+    modules = set()
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", MAIN_PATH, "--help"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(MAIN_PATH),
+        )
+        run_modules, total_us = parse_importtime(result.stderr)
+        modules |= run_modules
+        timings.append(total_us / 1000)
+    return modules, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    modules, timings = measure(args.runs)
+    best = min(timings)
+    print(f"main.py --help import time: best {best:.1f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+
+    heavy = [module for module in HEAVY_MODULES if module in modules]
+    ok = True
+    if heavy:
+        print(f"FAIL: heavy modules imported at startup: {heavy}")
+        ok = False
+    if best > args.budget_ms:
+        print(f"FAIL: import time {best:.1f} ms exceeds the budget of {args.budget_ms:.0f} ms")
+        ok = False
+    if ok:
+        print("OK")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
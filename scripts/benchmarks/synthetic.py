@@ -0,0 +1,124 @@
+"""
+Synthetic stand-ins for the rasters exported by make_training_data.
+
+Each raster has the same layout as the Earth Engine exports: 16 int16 bands
+in the order below, tiled and with overviews like a cloud-optimised GeoTIFF,
+at roughly 90 m per pixel. A share of the area is zero everywhere (ocean or
+outside the country's bounding box) and the last band holds clustered
+flooded pixels.
+"""
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+BAND_NAMES = [
+    "elevation",
+    "landcover",
+    "slope",
+    "ghsl",
+    "flow_direction",
+    "stream_distance",
+    "flow_accumulation",
+    "spi",
+    "sti",
+    "cti",
+    "tpi",
+    "tri",
+    "pcurv",
+    "tcurv",
+    "aspect",
+    "flooded_mask",
+]
+
+LANDCOVER_CLASSES = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100]
+
+PIXEL_SIZE = 1 / 1200  # About 90 m at the equator
+
+# Side of the square cells that are flooded or not as a whole
+FLOOD_CELL = 64
+
+
+def land_mask(rows, cols, width, height, nodata_fraction):
+    """
+    A wavy "coastline": roughly the left nodata_fraction of the raster is
+    empty. rows and cols are absolute pixel indices.
+    """
+    x = cols[np.newaxis, :] / width
+    y = rows[:, np.newaxis] / height
+    coast = nodata_fraction + 0.08 * np.sin(y * 2 * np.pi * 3) * min(nodata_fraction, 1 - nodata_fraction)
+    return x >= coast
+
+
+def write_synthetic_raster(
+    path,
+    width,
+    height,
+    nodata_fraction=0.3,
+    flood_fraction=0.02,
+    seed=0,
+    blocksize=256,
+    compress="deflate",
+    overviews=True,
+):
+    """
+    Write a synthetic 16-band int16 GeoTIFF to path, one strip of blocks at a
+    time so that large rasters don't have to fit in memory.
+
+    Parameters:
+    - width, height: Size in pixels
+    - nodata_fraction: Approximate share of the area that is zero in every band
+    - flood_fraction: Approximate share of land pixels flagged as flooded
+    - seed: Seed of the random generator, for reproducible rasters
+    - blocksize: Internal tile size
+    - compress: GeoTIFF compression, or None
+    - overviews: Whether to build overviews, as a COG would have
+    """
+    rng = np.random.default_rng(seed)
+
+    # Flooding happens in clustered cells; half the pixels of a flooded cell are flooded
+    coarse_shape = (height // FLOOD_CELL + 1, width // FLOOD_CELL + 1)
+    flooded_cells = rng.random(coarse_shape) < min(1.0, 2 * flood_fraction)
+
+    profile = {
+        "driver": "GTiff",
+        "width": width,
+        "height": height,
+        "count": len(BAND_NAMES),
+        "dtype": "int16",
+        "crs": "EPSG:4326",
+        "transform": from_origin(-85.0, 11.0, PIXEL_SIZE, PIXEL_SIZE),
+        "tiled": True,
+        "blockxsize": blocksize,
+        "blockysize": blocksize,
+        "interleave": "pixel",
+    }
+    if compress:
+        profile["compress"] = compress
+
+    cols = np.arange(width)
+    with rasterio.open(path, "w", **profile) as dst:
+        for row_off in range(0, height, blocksize):
+            strip_height = min(blocksize, height - row_off)
+            rows = np.arange(row_off, row_off + strip_height)
+            shape = (strip_height, width)
+            land = land_mask(rows, cols, width, height, nodata_fraction)
+
+            strip = np.empty((len(BAND_NAMES), strip_height, width), dtype="int16")
+            strip[0] = rng.integers(1, 3000, shape)  # elevation
+            strip[1] = rng.choice(LANDCOVER_CLASSES, shape)  # landcover
+            strip[2:15] = rng.integers(-500, 5000, (13, *shape))
+            cells = flooded_cells[rows[:, np.newaxis] // FLOOD_CELL, cols[np.newaxis, :] // FLOOD_CELL]
+            strip[15] = cells & (rng.random(shape) < 0.5)
+            strip *= land
+
+            dst.write(strip, window=Window(0, row_off, width, strip_height))
+
+        if overviews:
+            factors = [f for f in (2, 4, 8, 16, 32) if min(width, height) // f >= blocksize]
+            if factors:
+                dst.build_overviews(factors, Resampling.nearest)
+
+    return path
@@ -1,70 +1,416 @@
 import os
 import argparse
-import ee
-import rasterio
 from dotenv import load_dotenv
-from google.cloud import storage
 
-from utils.make_raw_dat import make_raw_dat
-from utils.make_chips import make_chips
-from utils.process_chips import process_chips
-import argparse
+# Only lightweight modules are imported here. Earth Engine, rasterio, numpy,
+# pandas and the storage client are loaded by the stages that use them, so
+# `main.py --help` and spawned worker processes start quickly.
+# scripts/benchmarks/import_time.py checks this stays within budget.
+from utils.scheduler import Stage, StagePipeline
+from utils.run_manifest import FAILED, RunManifest, fingerprint
+from utils.run_report import report
+from utils.storage_backend import (
+    BACKENDS,
+    DEFAULT_HTTP_POOL_SIZE,
+    GCS,
+    configure_block_cache,
+    configure_client,
+    get_bucket,
+)
+from utils.chip_encoding import BLOCK_SIZES, COMPRESSIONS, DEFAULT_ENCODING, ChipEncoding
+from utils.tile_plan import DEFAULT_PLAN, EDGE_POLICIES, TilePlan, plan_prefix
+from utils.transfer import configure_transfers
 import time 
+import threading
 import traceback
-import pretty_errors
-
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 
 # Load and retrieve environment variables
 load_dotenv()
 cloud_project = os.getenv("GOOGLE_CLOUD_PROJECT_NAME")
 key_path = os.getenv("GOOGLE_CLOUD_KEY_PATH")
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
+if key_path:
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
 
 # Set GDAL environment configurations for GCS URLs
 os.environ["GDAL_DISABLE_READDIR_ON_OPEN"] = "YES"
 os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] = "tif"
 
-client = storage.Client(project=cloud_project)
 
+main_bucket_name = "hotspotstoplight_floodmapping"
+base_path = "deep_learning"
 
-# Function to process flood data for a specific country
-def process_country(place_name):
-    print(f"Initializing Earth Engine for {place_name}...")
-    ee.Initialize(project=cloud_project)
-    print(f"Processing data for {place_name}...")
+# Worker pools of the stage scheduler: exports spend their time waiting on
+# Earth Engine, chipping moves objects in and out of the bucket, and
+# processing is CPU- and memory-bound
+EXPORT_POOL = "io_wait"
+CHIP_POOL = "transfer"
+PROCESS_POOL = "cpu"
 
-    snake_case_place_name = place_name.replace(" ", "_").lower()
-    main_bucket_name = "hotspotstoplight_floodmapping"
-    main_bucket = client.get_bucket(main_bucket_name)
-    base_path = "deep_learning"
+_ee_initialized = False
+_ee_lock = threading.Lock()
+_emdat_events = None
+_emdat_lock = threading.Lock()
 
+
+def country_paths(place_name, plan=DEFAULT_PLAN):
+    snake_case_place_name = place_name.replace(" ", "_").lower()
     raw_data_path = f"{base_path}/data/raw/{snake_case_place_name}"
-    chips_data_path = f"{base_path}/data/chips/{snake_case_place_name}"
-    processed_data_path = f"{base_path}/data/processed/{snake_case_place_name}"
+    chips_data_path = plan_prefix(f"{base_path}/data/chips/{snake_case_place_name}", plan)
+    processed_data_path = plan_prefix(f"{base_path}/data/processed/{snake_case_place_name}", plan)
+    return raw_data_path, chips_data_path, processed_data_path
+
+
+# Runs a stage unless the manifest shows it already finished on the same inputs.
+# replaces names the stages whose output this one overwrites: their records
+# are forgotten before it runs, so they aren't skipped over its output later
+def run_checkpointed(manifest, place_name, stage, stage_fingerprint, func, replaces=()):
+    def run():
+        # Everything the stage records in the run report is attributed to it
+        with report.scope(place_name, stage), report.timer("total"):
+            func()
+
+    if manifest is None:
+        run()
+        return
+    if manifest.is_done(place_name, stage, stage_fingerprint):
+        print(f"Skipping {stage} for {place_name}: finished in a previous run")
+        return
+    for replaced in replaces:
+        manifest.forget(place_name, replaced)
+    try:
+        run()
+    except Exception:
+        manifest.record(place_name, stage, stage_fingerprint, FAILED)
+        raise
+    if stage == "export" and manifest.has_failures(place_name, stage):
+        # Some exports failed; leave the stage open so the next run retries them
+        print(f"Some exports failed for {place_name}; they will be retried on the next run")
+        return
+    manifest.record(place_name, stage, stage_fingerprint)
+
+
+# Earth Engine only needs initializing once per process, not once per country
+def initialize_earth_engine():
+    global _ee_initialized
+    import ee
+
+    with _ee_lock:
+        if not _ee_initialized:
+            print("Initializing Earth Engine...")
+            ee.Initialize(project=cloud_project)
+            _ee_initialized = True
+
+
+# The EM-DAT workbook is downloaded and split by country once per process, by
+# the first export that runs, rather than once per country
+def shared_emdat_events():
+    global _emdat_events
+    from utils.filter_emdat import load_emdat_events
+
+    with _emdat_lock:
+        if _emdat_events is None:
+            print("Loading EM-DAT events...")
+            _emdat_events = load_emdat_events()
+    return _emdat_events
+
+
+# Stage 1: export the raw GeoTIFFs from Earth Engine and wait for them
+def export_stage(
+    place_name, manifest=None, bucket=None, emdat_events=None, emdat_generation=None, shared_emdat=False
+):
+    from utils.filter_emdat import get_emdat_generation
+    from utils.make_raw_dat import make_raw_dat
+
+    raw_data_path, _, _ = country_paths(place_name)
+    stage_fingerprint = None
+    if manifest is not None:
+        if emdat_generation is None:
+            emdat_generation = get_emdat_generation()
+        stage_fingerprint = fingerprint(place_name, raw_data_path, emdat_generation)
+
+    def run():
+        initialize_earth_engine()
+        print(f"Processing data for {place_name}...")
+
+        main_bucket = bucket if bucket is not None else get_bucket(main_bucket_name)
 
-    # Create raw data
-    make_raw_dat(place_name, main_bucket, raw_data_path)
+        # Create raw data
+        make_raw_dat(
+            place_name,
+            main_bucket,
+            raw_data_path,
+            manifest=manifest,
+            emdat_events=shared_emdat_events() if shared_emdat else emdat_events,
+        )
 
-    # Chip the raw data
-    make_chips(main_bucket, raw_data_path, chips_data_path)
+    run_checkpointed(manifest, place_name, "export", stage_fingerprint, run)
 
-    # Process the chips
-    process_chips(main_bucket, chips_data_path, processed_data_path)
 
+# Stage 2: chip the raw data
+def chip_stage(place_name, manifest=None, cpu_executor=None, bucket=None, prefilter=None, chip_format="tif", plan=DEFAULT_PLAN, incremental=True, encoding=DEFAULT_ENCODING):
+    from utils.make_chips import make_chips
+
+    main_bucket = bucket if bucket is not None else get_bucket(main_bucket_name)
+    raw_data_path, chips_data_path, _ = country_paths(place_name, plan)
+    stage_fingerprint = None
+    if manifest is not None:
+        # The chips depend on exactly which raw rasters exist, and which version of each
+        raw_blobs = [
+            (blob.name, blob.generation)
+            for blob in main_bucket.list_blobs(prefix=raw_data_path)
+            if blob.name.endswith(".tif")
+        ]
+        stage_fingerprint = fingerprint(raw_blobs, prefilter, chip_format, plan.to_dict(), encoding.to_dict())
+
+    run_checkpointed(
+        manifest,
+        place_name,
+        "chips",
+        stage_fingerprint,
+        lambda: make_chips(
+            main_bucket,
+            raw_data_path,
+            chips_data_path,
+            executor=cpu_executor,
+            prefilter=prefilter,
+            chip_format=chip_format,
+            plan=plan,
+            incremental=incremental,
+            encoding=encoding,
+        ),
+    )
+
+
+# Stage 3: process the chips
+def process_stage(place_name, manifest=None, cpu_executor=None, bucket=None, plan=DEFAULT_PLAN, streaming=False, layout="onehot", precision="float64"):
+    from utils.process_chips import process_chips
+
+    main_bucket = bucket if bucket is not None else get_bucket(main_bucket_name)
+    _, chips_data_path, processed_data_path = country_paths(place_name, plan)
+    stage_fingerprint = None
+    if manifest is not None:
+        # Chained to the chips stage, so the chips don't have to be listed again
+        chips_record = manifest.get(place_name, "chips")
+        stage_fingerprint = fingerprint(chips_record[0] if chips_record else None, layout, precision)
+
+    run_checkpointed(
+        manifest,
+        place_name,
+        "process",
+        stage_fingerprint,
+        lambda: process_chips(
+            main_bucket,
+            chips_data_path,
+            processed_data_path,
+            executor=cpu_executor,
+            streaming=streaming,
+            layout=layout,
+            precision=precision,
+        ),
+        # Both write the processed data
+        replaces=["fused"],
+    )
+    print(f"Finished processing {place_name}")
+
+
+# Stages 2 and 3 fused: chip the raw data and process the flooded chips in memory
+def fused_stage(place_name, manifest=None, cpu_executor=None, bucket=None, prefilter=None, keep_chips=False, chip_format="tif", plan=DEFAULT_PLAN, encoding=DEFAULT_ENCODING, layout="onehot", precision="float64"):
+    from utils.chip_and_process import chip_and_process
+
+    main_bucket = bucket if bucket is not None else get_bucket(main_bucket_name)
+    raw_data_path, chips_data_path, processed_data_path = country_paths(place_name, plan)
+    stage_fingerprint = None
+    if manifest is not None:
+        raw_blobs = [
+            (blob.name, blob.generation)
+            for blob in main_bucket.list_blobs(prefix=raw_data_path)
+            if blob.name.endswith(".tif")
+        ]
+        stage_fingerprint = fingerprint(raw_blobs, prefilter, keep_chips, chip_format, plan.to_dict(), encoding.to_dict(), layout, precision)
+
+    run_checkpointed(
+        manifest,
+        place_name,
+        "fused",
+        stage_fingerprint,
+        lambda: chip_and_process(
+            main_bucket,
+            raw_data_path,
+            chips_data_path,
+            processed_data_path,
+            executor=cpu_executor,
+            prefilter=prefilter,
+            keep_chips=keep_chips,
+            chip_format=chip_format,
+            plan=plan,
+            encoding=encoding,
+            layout=layout,
+            precision=precision,
+        ),
+        replaces=["process"],
+    )
     print(f"Finished processing {place_name}")
 
-def main(countries):
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        # Submit tasks to the executor
-        future_to_country = {executor.submit(process_country, country): country for country in countries}
-        for future in as_completed(future_to_country):
-            country = future_to_country[future]
-            try:
-                future.result()  # Get the result of the execution
-            except Exception as e:
-                print(f"An error occurred processing {country}: {e}")
+
+def main(
+    countries,
+    export_workers=4,
+    chip_workers=2,
+    process_workers=1,
+    manifest_path="run_manifest.sqlite",
+    fresh=False,
+    cpu_workers=0,
+    storage_backend=GCS,
+    local_root=None,
+    http_pool_size=None,
+    transfer_concurrency=None,
+    report_path="run_report.json",
+    block_cache_mb=None,
+    chip_prefilter=None,
+    fused=False,
+    keep_chips=False,
+    chip_format="tif",
+    tile_plan=DEFAULT_PLAN,
+    chip_encoding=DEFAULT_ENCODING,
+    stream_processing=False,
+    landcover_layout="onehot",
+    output_precision="float64",
+):
+    # One storage client per process is shared by every stage; size its
+    # connection pool for the transfers that run at the same time
+    if http_pool_size:
+        configure_client(http_pool_size)
+    if transfer_concurrency:
+        configure_transfers(transfer_concurrency)
+        if not http_pool_size:
+            # Every transfer in flight needs its own connection
+            configure_client(max(transfer_concurrency, DEFAULT_HTTP_POOL_SIZE))
+    if block_cache_mb:
+        configure_block_cache(block_cache_mb)
+    main_bucket = get_bucket(main_bucket_name, storage_backend, local_root)
+    manifest = RunManifest(manifest_path) if manifest_path else None
+    if manifest is not None and fresh:
+        for country in countries:
+            manifest.clear(country)
+
+    # The decode/tile/encode work of the chip stages is fanned out to worker
+    # processes, so it isn't serialised by the GIL. Exports and the scheduler
+    # itself stay on threads. Spawned (not forked) workers start without
+    # copies of the parent's threads and network clients.
+    cpu_executor = None
+    if cpu_workers > 0:
+        cpu_executor = ProcessPoolExecutor(
+            max_workers=cpu_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    # Each country runs export -> chips -> process, but every stage is handed to
+    # its own pool, so one country's chipping overlaps another's export wait.
+    # Fused runs chip and process in one stage, with the chips kept in memory.
+    if fused:
+        stages = [
+            Stage(
+                "fused",
+                partial(
+                    fused_stage,
+                    manifest=manifest,
+                    cpu_executor=cpu_executor,
+                    bucket=main_bucket,
+                    prefilter=chip_prefilter,
+                    keep_chips=keep_chips,
+                    chip_format=chip_format,
+                    plan=tile_plan,
+                    encoding=chip_encoding,
+                    layout=landcover_layout,
+                    precision=output_precision,
+                ),
+                PROCESS_POOL,
+            ),
+        ]
+    else:
+        stages = [
+            Stage(
+                "chips",
+                partial(
+                    chip_stage,
+                    manifest=manifest,
+                    cpu_executor=cpu_executor,
+                    bucket=main_bucket,
+                    prefilter=chip_prefilter,
+                    chip_format=chip_format,
+                    plan=tile_plan,
+                    # --fresh re-chips every raster, not only new or modified ones
+                    incremental=not fresh,
+                    encoding=chip_encoding,
+                ),
+                CHIP_POOL,
+            ),
+            Stage(
+                "process",
+                partial(
+                    process_stage,
+                    manifest=manifest,
+                    cpu_executor=cpu_executor,
+                    bucket=main_bucket,
+                    plan=tile_plan,
+                    streaming=stream_processing,
+                    layout=landcover_layout,
+                    precision=output_precision,
+                ),
+                PROCESS_POOL,
+            ),
+        ]
+    if storage_backend == GCS:
+        from utils.filter_emdat import get_emdat_generation
+
+        # Shared by every country's export. Only the workbook's generation is
+        # fetched up front, for the manifest fingerprints; Earth Engine is
+        # initialized, and the workbook loaded, by the first export that
+        # isn't already finished, so a fully checkpointed rerun does neither
+        emdat_generation = get_emdat_generation()
+        stages.insert(
+            0,
+            Stage(
+                "export",
+                partial(
+                    export_stage,
+                    manifest=manifest,
+                    bucket=main_bucket,
+                    emdat_generation=emdat_generation,
+                    shared_emdat=True,
+                ),
+                EXPORT_POOL,
+            ),
+        )
+    else:
+        # Earth Engine can only export to GCS, so a local run starts from raw
+        # rasters that were already staged under the local root
+        print(f"Using local storage under {local_root}; skipping Earth Engine exports.")
+
+    pipeline = StagePipeline(
+        stages=stages,
+        pool_sizes={
+            EXPORT_POOL: export_workers,
+            CHIP_POOL: chip_workers,
+            PROCESS_POOL: process_workers,
+        },
+    )
+    try:
+        errors = pipeline.run(countries)
+    finally:
+        if cpu_executor is not None:
+            cpu_executor.shutdown()
+    failed = [country for country, error in errors.items() if error is not None]
+    if failed:
+        print(f"Countries that did not finish: {failed}")
+
+    report.print_summary()
+    if report_path:
+        report.write(report_path)
+        print(f"Run report written to {report_path}")
 
 
 if __name__ == "__main__":
@@ -72,10 +418,66 @@ if __name__ == "__main__":
     start_time = time.time()  # Start the timer
     try:
         parser = argparse.ArgumentParser(description="Process flood data for given countries.")
-        parser.add_argument("countries", metavar="Country", type=str, nargs="+", help="A list of countries to process")
+        parser.add_argument("countries", metavar="Country", type=str, nargs="*", help="A list of countries to process")
+        parser.add_argument("--all", action="store_true", help="Process every country in utils/iso_codes.py")
+        parser.add_argument("--export-workers", type=int, default=4, help="Countries whose Earth Engine exports can be submitted and awaited at the same time")
+        parser.add_argument("--chip-workers", type=int, default=2, help="Countries that can be chipped at the same time")
+        parser.add_argument("--process-workers", type=int, default=1, help="Countries whose chips can be processed at the same time")
+        parser.add_argument("--manifest", type=str, default="run_manifest.sqlite", help="SQLite file recording finished stages, so reruns resume where they stopped (empty string disables it)")
+        parser.add_argument("--fresh", action="store_true", help="Forget the manifest records of the given countries and run every stage again")
+        parser.add_argument("--cpu-workers", type=int, default=0, help="Worker processes for the CPU-bound chipping and chip decoding (0 runs them in the stage threads)")
+        parser.add_argument("--storage", choices=BACKENDS, default=GCS, help="Where chipping and processing read and write their data")
+        parser.add_argument("--local-root", type=str, default=None, help="Directory holding a local copy of the bucket, for --storage local")
+        parser.add_argument("--http-pool-size", type=int, default=None, help="Connections kept open per host by the shared storage client (default 32)")
+        parser.add_argument("--transfer-concurrency", type=int, default=None, help="Chip uploads and downloads kept in flight per process (default 32)")
+        parser.add_argument("--block-cache-mb", type=int, default=None, help="GDAL block cache per process for windowed raster reads, in MB (default 256)")
+        parser.add_argument("--chip-prefilter", choices=["none", "auto", "mask", "overview", "landcover"], default="none", help="Cheap check that drops empty tiles before their 16 bands are read. Each can drop tiles a full read keeps: mask those under the internal mask, overview slivers the 1/8 overview misses, landcover those with no WorldCover class; auto uses mask when the raster has one (Earth Engine exports don't)")
+        parser.add_argument("--fused", action="store_true", help="Chip and process each country in one stage, passing flooded chips on in memory")
+        parser.add_argument("--keep-chips", action="store_true", help="With --fused, still upload the chips to the bucket")
+        parser.add_argument("--chip-format", choices=["tif", "shards"], default="tif", help="Write one GeoTIFF object per chip, or pack the chips into large indexed shards")
+        parser.add_argument("--tile-size", type=int, default=512, help="Side of the square chips, in pixels")
+        parser.add_argument("--tile-stride", type=int, default=None, help="Distance between neighbouring chips (default the tile size; less gives overlapping chips)")
+        parser.add_argument("--tile-edge", choices=EDGE_POLICIES, default="pad", help="Chips running past the raster's edge are zero-padded, dropped, or shifted inward")
+        parser.add_argument("--chip-dtype", type=str, default=None, help="Data type the chips are stored in (default that of the raw rasters)")
+        parser.add_argument("--chip-compression", choices=COMPRESSIONS, default="none", help="Compression codec of the chip GeoTIFFs (with the horizontal predictor)")
+        parser.add_argument("--chip-blocksize", type=int, choices=[size for size in BLOCK_SIZES if size], default=None, help="Write chips as internal tiles of this size rather than strips")
+        parser.add_argument("--stream-processing", action="store_true", help="Process chips in two streaming passes over one batch at a time, so memory use doesn't grow with the country's size")
+        parser.add_argument("--landcover-layout", choices=["onehot", "index"], default="onehot", help="Store processed landcover as one-hot channels of the images, or as a compact uint8 class index expanded when loaded")
+        parser.add_argument("--output-precision", choices=["float64", "float32", "float16", "uint16", "uint8"], default="float64", help="Data type of the processed images; uint16 and uint8 quantize them, recording the scale and offset in metadata.json")
+        parser.add_argument("--report", type=str, default="run_report.json", help="Where to write per-country, per-stage timings and throughput (.json or .csv; a CSV report's notes, such as the output precision's size and error, go to <name>_notes.csv)")
         args = parser.parse_args()
+        if args.all:
+            from utils.iso_codes import iso_codes
+
+            args.countries = list(dict.fromkeys(args.countries + iso_codes))
+        if not args.countries:
+            parser.error("give at least one country, or --all")
+        import pretty_errors  # Only needed once there is work to do
         print("Countries to process:", args.countries)  # Debug print
-        main(args.countries)
+        main(
+            args.countries,
+            args.export_workers,
+            args.chip_workers,
+            args.process_workers,
+            manifest_path=args.manifest,
+            fresh=args.fresh,
+            cpu_workers=args.cpu_workers,
+            storage_backend=args.storage,
+            local_root=args.local_root,
+            http_pool_size=args.http_pool_size,
+            transfer_concurrency=args.transfer_concurrency,
+            report_path=args.report,
+            block_cache_mb=args.block_cache_mb,
+            chip_prefilter=None if args.chip_prefilter == "none" else args.chip_prefilter,
+            fused=args.fused,
+            keep_chips=args.keep_chips,
+            chip_format=args.chip_format,
+            tile_plan=TilePlan(args.tile_size, args.tile_stride, args.tile_edge, args.chip_dtype),
+            chip_encoding=ChipEncoding(args.chip_compression, args.chip_blocksize),
+            stream_processing=args.stream_processing,
+            landcover_layout=args.landcover_layout,
+            output_precision=args.output_precision,
+        )
     except Exception as e:
         print("An error occurred:", e)
         traceback.print_exc()
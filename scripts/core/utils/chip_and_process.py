@@ -0,0 +1,54 @@
+from utils.chip_encoding import DEFAULT_ENCODING
+from utils.chip_shards import CHIP_FORMAT_TIF
+from utils.make_chips import make_chips
+from utils.process_chips import process_arrays
+from utils.processed_data import LAYOUT_ONEHOT, PRECISION_FLOAT64
+from utils.run_report import report
+from utils.tile_plan import DEFAULT_PLAN
+
+
+def chip_and_process(
+    bucket,
+    input_path_prefix,
+    chips_path_prefix,
+    output_path_prefix,
+    executor=None,
+    prefilter=None,
+    keep_chips=False,
+    encoder=None,
+    chip_format=CHIP_FORMAT_TIF,
+    plan=DEFAULT_PLAN,
+    encoding=DEFAULT_ENCODING,
+    layout=LAYOUT_ONEHOT,
+    precision=PRECISION_FLOAT64,
+):
+    """
+    Chip the rasters under input_path_prefix and process the flooded chips
+    in one pass, giving the same arrays as make_chips followed by
+    process_chips.
+
+    Tiles go from the chipper to processing in memory, and tiles without
+    flooded pixels are dropped before they are encoded. The chips are only
+    written to chips_path_prefix, in chip_format and with the given
+    encoding, if keep_chips is set, so
+    by default no chip is encoded, uploaded, listed, downloaded or decoded.
+    Landcover is saved in the given layout and the images in the given
+    precision (see processed_data).
+    """
+    flooded = make_chips(
+        bucket,
+        input_path_prefix,
+        chips_path_prefix,
+        executor=executor,
+        prefilter=prefilter,
+        keep_flooded=True,
+        upload=keep_chips,
+        chip_format=chip_format,
+        plan=plan,
+        encoding=encoding,
+    )
+    report.add("flooded_chips", 0, items=len(flooded))
+
+    arrays = [array for _, array in flooded]
+    masks_to_save = [array[-1, :, :] for array in arrays]
+    process_arrays(bucket, arrays, masks_to_save, output_path_prefix, encoder, layout, precision, executor)
@@ -0,0 +1,73 @@
+# Compression codecs for chip GeoTIFFs
+COMPRESSION_NONE = "none"
+COMPRESSION_DEFLATE = "deflate"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_LZW = "lzw"
+COMPRESSIONS = [COMPRESSION_NONE, COMPRESSION_DEFLATE, COMPRESSION_ZSTD, COMPRESSION_LZW]
+
+# Internal tile sizes; None writes strips, as chips always were
+BLOCK_SIZES = [None, 256, 512]
+
+
+class ChipEncoding:
+    """
+    How chips are stored as GeoTIFFs: the compression codec and the size of
+    the internal tiles (None for strips).
+
+    Compressed chips use the horizontal predictor (the floating point one
+    for float chips), which turns smooth terrain bands into small
+    differences that compress much better. The encoding only changes the
+    bytes of a chip, not what it decodes to, so it isn't part of the tile
+    plan or of where chips go.
+    """
+
+    def __init__(self, compression=COMPRESSION_NONE, blocksize=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+        if blocksize not in BLOCK_SIZES:
+            raise ValueError(f"Unsupported block size {blocksize}, expected one of {BLOCK_SIZES}")
+        self.compression = compression
+        self.blocksize = blocksize
+
+    def to_dict(self):
+        return {"compression": self.compression, "blocksize": self.blocksize}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, ChipEncoding) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"ChipEncoding({self.to_dict()})"
+
+    @property
+    def name(self):
+        """Short label for the encoding, e.g. "zstd_tiles256"."""
+        name = self.compression
+        if self.blocksize:
+            name += f"_tiles{self.blocksize}"
+        return name
+
+    def creation_options(self, dtype, size):
+        """GTiff creation options for chips of size x size pixels of dtype."""
+        options = {}
+        if self.compression != COMPRESSION_NONE:
+            options["compress"] = self.compression
+            options["predictor"] = 3 if str(dtype).startswith("float") else 2
+        # Blocks must be multiples of 16 and no larger than the chip
+        if self.blocksize and size % 16 == 0:
+            blocksize = min(self.blocksize, size)
+            options.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+        return options
+
+
+DEFAULT_ENCODING = ChipEncoding()
+
+# The encodings compared by benchmarks/bench_chip_encoding.py
+PROFILES = [
+    ChipEncoding(compression, blocksize)
+    for compression in COMPRESSIONS
+    for blocksize in BLOCK_SIZES
+]
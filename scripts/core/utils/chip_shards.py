@@ -0,0 +1,106 @@
+import io
+import json
+import os
+
+from utils.run_report import report
+from utils.transfer import get_engine
+
+# Chip formats make_chips can write
+CHIP_FORMAT_TIF = "tif"
+CHIP_FORMAT_SHARDS = "shards"
+CHIP_FORMATS = [CHIP_FORMAT_TIF, CHIP_FORMAT_SHARDS]
+
+SHARD_SUFFIX = ".chips"
+INDEX_SUFFIX = ".index.json"
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+
+
+class ShardWriter:
+    """
+    Packs encoded chips into shard objects of about shard_bytes each, instead
+    of writing one object per chip.
+
+    A shard <prefix>/<name>.chips is the chips' GeoTIFF bytes one after the
+    other. Its index <prefix>/<name>.index.json lists every chip's key, byte offset
+    and length, georeferencing and date, so a reader can fetch a single chip
+    with one range request. The index is uploaded after its shard, so a
+    shard is only visible to readers once it is complete.
+    """
+
+    def __init__(self, bucket, prefix, name, shard_bytes=DEFAULT_SHARD_BYTES, engine=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.name = name
+        self.shard_bytes = shard_bytes
+        self.engine = engine or get_engine()
+        self.uploads = []
+        self._shard_number = 0
+        self._buffer = io.BytesIO()
+        self._entries = []
+
+    def add(self, key, data, **meta):
+        """Add one encoded chip; meta is stored with it in the index."""
+        self._entries.append(
+            dict(key=key, offset=self._buffer.tell(), length=len(data), **meta)
+        )
+        self._buffer.write(data)
+        if self._buffer.tell() >= self.shard_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._entries:
+            return
+        shard_name = f"{self.name}-{self._shard_number:05d}"
+        data_blob = self.bucket.blob(os.path.join(self.prefix, shard_name + SHARD_SUFFIX))
+        index_blob = self.bucket.blob(os.path.join(self.prefix, shard_name + INDEX_SUFFIX))
+        index = {"shard": data_blob.name, "chips": self._entries}
+        self.uploads.append(
+            self.engine.submit(_upload_shard, data_blob, self._buffer.getvalue(), index_blob, index)
+        )
+        self._shard_number += 1
+        self._buffer = io.BytesIO()
+        self._entries = []
+
+    def close(self):
+        """Upload the last partial shard; returns the futures of all shard uploads."""
+        self.flush()
+        return self.uploads
+
+
+def _upload_shard(data_blob, data, index_blob, index):
+    with report.timer("upload", items=1, nbytes=len(data)):
+        data_blob.upload_from_string(data, content_type="application/octet-stream")
+        index_blob.upload_from_string(json.dumps(index), content_type="application/json")
+
+
+def is_shard_index(blob):
+    return blob.name.endswith(INDEX_SUFFIX)
+
+
+def read_index(index_blob):
+    """Returns the chip entries of one shard, each with the shard's object name."""
+    index = json.loads(index_blob.download_as_bytes())
+    return [dict(entry, shard=index["shard"]) for entry in index["chips"]]
+
+
+def list_chips(bucket, prefix):
+    """Returns the index entries of every chip stored in shards under prefix, by key."""
+    entries = []
+    for blob in bucket.list_blobs(prefix=prefix):
+        if is_shard_index(blob):
+            entries.extend(read_index(blob))
+    return sorted(entries, key=lambda entry: entry["key"])
+
+
+def read_chip(bucket, entry):
+    """Fetch one chip's GeoTIFF bytes with a single range request."""
+    start = entry["offset"]
+    return bucket.blob(entry["shard"]).download_as_bytes(
+        start=start, end=start + entry["length"] - 1
+    )
+
+
+def split_shard(data, entries):
+    """Yield (entry, GeoTIFF bytes) for the chips of a shard downloaded whole."""
+    for entry in entries:
+        yield entry, data[entry["offset"]:entry["offset"] + entry["length"]]
@@ -0,0 +1,107 @@
+import io
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from utils.landcover import WORLDCOVER_CLASSES
+
+# The landcover histogram columns follow WORLDCOVER_CLASSES
+LANDCOVER_INDEX = 1  # Band index of landcover in a chip
+MASK_INDEX = -1  # Band index of the flood mask in a chip
+
+STATS_FILE_NAME = "chip_stats.parquet"
+
+SCHEMA = pa.schema([
+    ("key", pa.string()),
+    ("date", pa.string()),
+    ("col_off", pa.int32()),
+    ("row_off", pa.int32()),
+    ("flood_pixels", pa.int64()),
+    ("valid_pixels", pa.int64()),
+    ("band_min", pa.list_(pa.float64())),
+    ("band_max", pa.list_(pa.float64())),
+    ("band_sum", pa.list_(pa.float64())),
+    ("band_sumsq", pa.list_(pa.float64())),
+    ("landcover_counts", pa.list_(pa.int64(), len(WORLDCOVER_CLASSES))),
+])
+
+
+def tile_stats(tile):
+    """
+    Statistics of one chip's bands (bands x height x width, as stored):
+    flooded pixels, pixels with data in any band, per-band min, max, sum and
+    sum of squares (ignoring NaNs), and pixels per WorldCover class.
+    """
+    if np.issubdtype(tile.dtype, np.floating):
+        band_min = np.nanmin(tile, axis=(1, 2))
+        band_max = np.nanmax(tile, axis=(1, 2))
+        band_sum = np.nansum(tile, axis=(1, 2), dtype=np.float64)
+        band_sumsq = np.nansum(np.square(tile, dtype=np.float64), axis=(1, 2))
+    else:
+        band_min = tile.min(axis=(1, 2))
+        band_max = tile.max(axis=(1, 2))
+        band_sum = tile.sum(axis=(1, 2), dtype=np.float64)
+        # Squares are summed in float64 without a float64 copy of the tile
+        band_sumsq = np.einsum("bij,bij->b", tile, tile, dtype=np.float64)
+    landcover = tile[LANDCOVER_INDEX]
+    return {
+        "flood_pixels": int(np.count_nonzero(tile[MASK_INDEX] == 1)),
+        "valid_pixels": int(np.count_nonzero(tile.any(axis=0))),
+        "band_min": band_min.astype(np.float64).tolist(),
+        "band_max": band_max.astype(np.float64).tolist(),
+        "band_sum": band_sum.tolist(),
+        "band_sumsq": band_sumsq.tolist(),
+        "landcover_counts": [int(np.count_nonzero(landcover == value)) for value in WORLDCOVER_CLASSES],
+    }
+
+
+def load_chip_stats(bucket, path_prefix):
+    """The statistics of the chips under path_prefix, or None if they have none."""
+    blob = bucket.get_blob(os.path.join(path_prefix, STATS_FILE_NAME))
+    if blob is None:
+        return None
+    return pq.read_table(io.BytesIO(blob.download_as_bytes()))
+
+
+def write_chip_stats(bucket, path_prefix, rows, replaced_dates=()):
+    """
+    Write the statistics of the chips under path_prefix. rows are the
+    statistics of the chips just made, of the rasters whose dates are in
+    replaced_dates; rows of other rasters, chipped in earlier runs, are kept.
+    """
+    table = pa.Table.from_pylist(rows, schema=SCHEMA)
+    existing = load_chip_stats(bucket, path_prefix)
+    if existing is not None and existing.schema.equals(SCHEMA):
+        replaced = pa.array(sorted(replaced_dates), type=pa.string())
+        kept = existing.filter(pc.invert(pc.is_in(existing["date"], value_set=replaced)))
+        table = pa.concat_tables([kept, table])
+    table = table.sort_by("key")
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd")
+    bucket.blob(os.path.join(path_prefix, STATS_FILE_NAME)).upload_from_string(
+        buffer.getvalue(), content_type="application/octet-stream"
+    )
+    return table
+
+
+def chips_without_floods(stats):
+    """Keys of the chips that have no flooded pixel, so need not be read."""
+    if stats is None:
+        return set()
+    return set(stats.filter(pc.equal(stats["flood_pixels"], 0))["key"].to_pylist())
+
+
+def band_ranges(stats, keys=None):
+    """
+    Per-band min and max over the chips with the given keys (all chips by
+    default), the same as nanmin and nanmax over the stacked chips.
+    """
+    if keys is not None:
+        stats = stats.filter(pc.is_in(stats["key"], value_set=pa.array(sorted(keys), type=pa.string())))
+    band_min = np.array(stats["band_min"].to_pylist(), dtype=np.float64)
+    band_max = np.array(stats["band_max"].to_pylist(), dtype=np.float64)
+    return np.nanmin(band_min, axis=0), np.nanmax(band_max, axis=0)
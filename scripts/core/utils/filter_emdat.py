@@ -1,37 +1,38 @@
-from google.cloud import storage
 import pandas as pd
 import io
 
-def filter_data_from_gcs(country_name):
-    """
-    Pulls data from an Excel file in a Google Cloud Storage bucket,
-    filters it based on a specified country name (case-insensitive),
-    and returns the filtered data.
+from utils.storage_backend import get_client
 
-    Parameters:
-    - country_name: The country name to filter the data by
+EMDAT_BUCKET_NAME = "hotspotstoplight_floodmapping"
+EMDAT_FILE_NAME = "data/emdat/public_emdat_custom_request_2024-02-10_39ba89ea-de1d-4020-9b8e-027db50a5ded.xlsx"
 
-    Returns:
-    - A list of tuples with the start and end dates for the filtered rows
+
+def get_emdat_generation(client=None):
     """
-    bucket_name = "hotspotstoplight_floodmapping"
-    file_name = "data/emdat/public_emdat_custom_request_2024-02-10_39ba89ea-de1d-4020-9b8e-027db50a5ded.xlsx"
+    Returns the GCS generation of the EM-DAT workbook, which changes whenever
+    the file is replaced. Only the object metadata is fetched.
+    """
+    client = client or get_client()
+    blob = client.bucket(EMDAT_BUCKET_NAME).get_blob(EMDAT_FILE_NAME)
+    return blob.generation if blob is not None else None
+
 
-    # Initialize a client and get the bucket and blob
-    client = storage.Client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(file_name)
+def _read_emdat(client=None):
+    # Get the bucket and blob
+    client = client or get_client()
+    bucket = client.bucket(EMDAT_BUCKET_NAME)
+    blob = bucket.blob(EMDAT_FILE_NAME)
 
     # Download the blob into an in-memory file
     content = blob.download_as_bytes()
 
     # Read the Excel file into a DataFrame
-    excel_data = pd.read_excel(io.BytesIO(content), engine="openpyxl")
+    return pd.read_excel(io.BytesIO(content), engine="openpyxl")
 
-    # Filter the DataFrame based on the 'Country' column, case-insensitive
-    filtered_data = excel_data[
-        excel_data["Country"].str.lower() == country_name.lower()
-    ]
+
+def _parse_dates(data):
+    """Adds start_date and end_date columns and returns the rows where both parsed."""
+    data = data.copy()
 
     # Process start and end dates
     for date_type in ['Start', 'End']:
@@ -43,27 +44,74 @@ def filter_data_from_gcs(country_name):
         # Combine the date components into a single date column
         combined_dates = pd.to_datetime(
             {
-                "year": filtered_data[year_col],
-                "month": filtered_data[month_col],
-                "day": filtered_data[day_col]
+                "year": data[year_col],
+                "month": data[month_col],
+                "day": data[day_col]
             }, errors='coerce')
 
         # Detect rows where dates could not be parsed and print them
-        invalid_rows = filtered_data[combined_dates.isna()]
+        invalid_rows = data[combined_dates.isna()]
         if not invalid_rows.empty:
             print(f"Invalid {date_type.lower()} dates detected:")
             print(invalid_rows[[year_col, month_col, day_col]])
 
         # Assign parsed dates back to the main DataFrame
-        filtered_data[date_col] = combined_dates
+        data[date_col] = combined_dates
 
     # Filter out rows where either start_date or end_date are NaT
-    valid_data = filtered_data.dropna(subset=['start_date', 'end_date'])
+    return data.dropna(subset=['start_date', 'end_date'])
+
 
+def _to_date_pairs(valid_data):
     # Create date pairs as a list of tuples
-    date_pairs = [
+    return [
         (start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
         for start_date, end_date in zip(valid_data['start_date'], valid_data['end_date'])
     ]
 
-    return date_pairs
+
+def filter_data_from_gcs(country_name, client=None, emdat_events=None):
+    """
+    Pulls data from an Excel file in a Google Cloud Storage bucket,
+    filters it based on a specified country name (case-insensitive),
+    and returns the filtered data.
+
+    Parameters:
+    - country_name: The country name to filter the data by
+    - client: Storage client to use, defaults to the shared one
+    - emdat_events: Events already partitioned by load_emdat_events; when
+      given, nothing is downloaded or parsed
+
+    Returns:
+    - A list of tuples with the start and end dates for the filtered rows
+    """
+    if emdat_events is not None:
+        return list(emdat_events.get(country_name.lower(), []))
+
+    excel_data = _read_emdat(client)
+
+    # Filter the DataFrame based on the 'Country' column, case-insensitive
+    filtered_data = excel_data[
+        excel_data["Country"].str.lower() == country_name.lower()
+    ]
+
+    return _to_date_pairs(_parse_dates(filtered_data))
+
+
+def load_emdat_events(client=None):
+    """
+    Downloads and parses the EM-DAT workbook once and partitions its events
+    by country, for runs that cover many countries.
+
+    Returns:
+    - A dict mapping each lower-case country name, and each lower-case ISO3
+      code, to its list of (start date, end date) tuples
+    """
+    valid_data = _parse_dates(_read_emdat(client))
+
+    key_columns = ["Country"] + (["ISO"] if "ISO" in valid_data.columns else [])
+    events = {}
+    for key_column in key_columns:
+        for key, rows in valid_data.groupby(valid_data[key_column].str.lower(), sort=False):
+            events[key] = _to_date_pairs(rows)
+    return events
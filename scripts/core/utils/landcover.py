@@ -0,0 +1,49 @@
+import numpy as np
+
+# ESA WorldCover classes, in the order of the one-hot landcover channels
+WORLDCOVER_CLASSES = [10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 100]
+
+
+class LandcoverEncoder:
+    """
+    One-hot encodes landcover with a lookup table over a fixed list of
+    classes, the ESA WorldCover ones by default: channel i is 1 where a
+    pixel's class is classes[i]. The channels are the same for every country
+    and run, whichever classes occur. Pixels of any other value, such as 0
+    where WorldCover has no data, are 0 in every channel.
+
+    The same classes can be stored compactly as a uint8 index per pixel
+    (see index), i + 1 for classes[i] and 0 for any other value.
+    """
+
+    def __init__(self, classes=WORLDCOVER_CLASSES, dtype=np.uint8):
+        self.classes = list(classes)
+        self.dtype = np.dtype(dtype)
+        # Column v of the table is the encoding of value v; the last column,
+        # past every class, is all zeros and stands for any other value
+        self._other = max(self.classes) + 1
+        self._table = np.zeros((len(self.classes), self._other + 1), dtype=self.dtype)
+        self._table[np.arange(len(self.classes)), self.classes] = 1
+        self._index_table = np.zeros(self._other + 1, dtype=np.uint8)
+        self._index_table[self.classes] = np.arange(1, len(self.classes) + 1)
+
+    @property
+    def num_channels(self):
+        return len(self.classes)
+
+    def encode(self, landcover, out=None):
+        """
+        The (channels, *landcover.shape) one-hot encoding of a landcover
+        array, written into out if given.
+        """
+        return np.take(self._table, self._lookup(landcover), axis=1, out=out)
+
+    def index(self, landcover, out=None):
+        """The uint8 class index of every pixel of a landcover array, written into out if given."""
+        return np.take(self._index_table, self._lookup(landcover), out=out)
+
+    def _lookup(self, landcover):
+        # Values outside the table, and NaN, all map to its "other" column
+        if not np.issubdtype(landcover.dtype, np.integer):
+            landcover = np.nan_to_num(landcover, nan=self._other, posinf=self._other, neginf=self._other)
+        return np.clip(landcover, 0, self._other).astype(np.intp, copy=False)
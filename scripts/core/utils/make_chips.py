@@ -1,71 +1,488 @@
+import json
 import os
+import time
 import numpy as np
+from concurrent.futures import as_completed
 from rasterio import windows
-from itertools import product
-from google.cloud import storage
 from dotenv import load_dotenv
 import rasterio
+from rasterio.enums import MaskFlags, Resampling
 from rasterio.io import MemoryFile
 
+from utils.chip_encoding import DEFAULT_ENCODING
+from utils.chip_shards import CHIP_FORMAT_SHARDS, CHIP_FORMAT_TIF, ShardWriter
+from utils.chip_stats import tile_stats, write_chip_stats
+from utils.run_report import report
+from utils.storage_backend import block_cache_bytes, from_worker_ref, open_raster, to_worker_ref
+from utils.tile_plan import DEFAULT_PLAN, save_plan
+from utils.transfer import get_engine, wait_all
+
 # Load environment variables
 load_dotenv()
 cloud_project = os.getenv("GOOGLE_CLOUD_PROJECT_NAME")
 key_path = os.getenv("GOOGLE_CLOUD_KEY_PATH")
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
+if key_path:
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
 os.environ["GDAL_DISABLE_READDIR_ON_OPEN"] = "YES"
 os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] = "tif"
 
-# Initialize Google Cloud Storage client
-client = storage.Client(project=cloud_project)
+# Cheap checks that decide a tile is empty before all of its bands are read.
+# None of them matches the full read's test, which keeps any tile with a
+# non-zero pixel, so chipping uses none unless one is asked for:
+# - "mask" reads the raster's internal mask, and drops tiles that are all
+#   masked, even if the masked pixels hold non-zero values;
+# - "overview" reads every band from the COG overviews at 1/8 resolution;
+#   overviews are nearest-resampled, so it drops tiles whose only data is a
+#   sliver the overview misses;
+# - "landcover" reads only the landcover band, and drops tiles where it is
+#   zero (WorldCover has no data at sea and beyond the export's footprint),
+#   whatever the other bands hold;
+# - "auto" uses "mask" when the raster has an internal mask, and otherwise
+#   no prefilter. Earth Engine exports have no internal mask.
+PREFILTER_AUTO = "auto"
+PREFILTER_MASK = "mask"
+PREFILTER_LANDCOVER = "landcover"
+PREFILTER_OVERVIEW = "overview"
+PREFILTERS = [PREFILTER_AUTO, PREFILTER_MASK, PREFILTER_LANDCOVER, PREFILTER_OVERVIEW]
+LANDCOVER_BAND = 2
+OVERVIEW_FACTOR = 8
+
+# One record per chipped raster lives under <chips prefix>/_sources/, noting
+# the raster's generation and the settings its chips were made with
+SOURCES_DIR = "_sources"
 
 # Function to get tiles from a dataset
-def get_tiles(ds, width=512, height=512):
-    nols, nrows = ds.meta['width'], ds.meta['height']
-    offsets = product(range(0, nols, width), range(0, nrows, height))
-    big_window = windows.Window(col_off=0, row_off=0, width=nols, height=nrows)
-    for col_off, row_off in offsets:
+def get_tiles(ds, plan=DEFAULT_PLAN):
+    """
+    Yield (window, transform) for every tile of the plan, in row-major order.
+
+    GeoTIFF blocks (tiles or strips) are stored row by row, so this order
+    reads each block once and in storage order. The tile grid starts at the
+    dataset's origin like its block grid, so when the block size divides the
+    tile size and stride (256 or 512 for the exports) every tile covers
+    whole blocks.
+    """
+    for col_off, row_off, width, height in plan.windows(ds.meta['width'], ds.meta['height']):
         window = windows.Window(col_off=col_off, row_off=row_off, width=width, height=height)
-        window = window.intersection(big_window)  # Ensure window is within image bounds
         transform = windows.transform(window, ds.transform)
         yield window, transform
-        
-        
+
+
+def get_tile_batches(ds, plan=DEFAULT_PLAN, max_tiles=8, max_row_bytes=None):
+    """
+    Group the tiles from get_tiles into batches of horizontally adjacent
+    tiles, so each batch can be read as one window covering whole blocks.
+
+    Yields (batch_window, tiles), where tiles is the batch's list of
+    (window, transform). A batch holds up to max_tiles tiles, so the read
+    buffer doesn't grow with the raster's width.
+
+    Rasters stored in strips are the exception: every strip spans the full
+    width, so each batch of a row decodes the strips of the whole row. When
+    a row of tiles takes at most max_row_bytes (by default the size of the
+    block cache, which would otherwise hold those strips), a batch is the
+    full row of tiles, so each strip is fetched and decoded once. Wider
+    rasters keep batches of max_tiles tiles, and the strips of a row are
+    decoded again for each batch once they no longer fit in the cache.
+    """
+    block_height, block_width = ds.block_shapes[0]
+    if block_width >= ds.meta['width']:
+        row_bytes = ds.count * plan.size * ds.meta['width'] * np.dtype(ds.dtypes[0]).itemsize
+        if row_bytes <= (block_cache_bytes() if max_row_bytes is None else max_row_bytes):
+            max_tiles = len(plan.offsets(ds.meta['width']))
+
+    batch = []
+    for window, transform in get_tiles(ds, plan):
+        if batch and (window.row_off != batch[0][0].row_off or len(batch) == max_tiles):
+            yield _batch_window(batch), batch
+            batch = []
+        batch.append((window, transform))
+    if batch:
+        yield _batch_window(batch), batch
+
+
+def _batch_window(batch):
+    first, last = batch[0][0], batch[-1][0]
+    return windows.Window(
+        col_off=first.col_off,
+        row_off=first.row_off,
+        width=last.col_off + last.width - first.col_off,
+        height=first.height,
+    )
+
+
+def _buffer_width(tiles, size):
+    # Width of a buffer holding the tiles side by side, each padded to full size
+    return tiles[-1][0].col_off - tiles[0][0].col_off + size
+
+
+def _contiguous_runs(tiles):
+    # Split a batch's remaining tiles into runs that can each be read as one window
+    run = []
+    for tile in tiles:
+        if run and tile[0].col_off > run[-1][0].col_off + run[-1][0].width:
+            yield run
+            run = []
+        run.append(tile)
+    if run:
+        yield run
+
+
+def _choose_prefilter(src, prefilter):
+    if prefilter != PREFILTER_AUTO:
+        return prefilter
+    # Of the cheap signals, only an internal mask is the raster's own
+    # statement of where it has no data; a nodata value or alpha band would
+    # take reading the bands themselves
+    if MaskFlags.per_dataset in src.mask_flag_enums[0]:
+        return PREFILTER_MASK
+    return None
+
+
+def _scratch(buffer, shape, dtype):
+    """
+    Returns (buffer, view): a view of the given shape into buffer, which is
+    only replaced by a larger one when it is too small.
+    """
+    if buffer is None or any(have < need for have, need in zip(buffer.shape, shape)):
+        grown = shape if buffer is None else tuple(max(have, need) for have, need in zip(buffer.shape, shape))
+        buffer = np.empty(grown, dtype=dtype)
+    return buffer, buffer[tuple(slice(0, need) for need in shape)]
+
+
+def _read_padded(src, window, out, indexes=None, factor=1, masks=False):
+    # Read the window (decimated by factor), or its masks, into the top-left
+    # of out and zero the rest in place, so tiles at the right and bottom
+    # edges come out padded
+    height = -(-window.height // factor)
+    width = -(-window.width // factor)
+    read = src.read_masks if masks else src.read
+    read(indexes, window=window, out=out[:, :height, :width], resampling=Resampling.nearest)
+    out[:, height:, :] = 0
+    out[:, :height, width:] = 0
+
+
+class TileReader:
+    """
+    Iterates over the non-empty tiles of an open raster, as laid out by the
+    plan, yielding (window, transform, tile).
+
+    Runs of tiles are read with one call into a buffer that is reused (and
+    only grown) from run to run, and each tile is copied out into a single
+    (bands, size, size) buffer, so the loop allocates no arrays per tile.
+    The yielded tile is overwritten by the next one; copy it to keep it.
+
+    With a prefilter (see PREFILTERS), tiles the cheap signal shows to be
+    empty are skipped without reading their bands. empty_tiles and
+    prefiltered_tiles count the tiles that were skipped.
+    """
+
+    def __init__(self, src, plan=DEFAULT_PLAN, prefilter=None):
+        self.src = src
+        self.plan = plan
+        self.prefilter = prefilter
+        self.empty_tiles = 0
+        self.prefiltered_tiles = 0
+        self.tile = np.empty((src.count, plan.size, plan.size), dtype=src.dtypes[0])
+        self._mask = np.empty((plan.size, plan.size), dtype=bool)
+        self._run = None
+        self._signal = None
+
+    def _has_data(self, batch_window, tiles):
+        """Returns, for each tile of the batch, whether the cheap signal shows any data."""
+        src, size = self.src, self.plan.size
+        # A decimated read is served from the overview closest to its resolution
+        factor = OVERVIEW_FACTOR if self.prefilter == PREFILTER_OVERVIEW else 1
+        masks = self.prefilter == PREFILTER_MASK
+        indexes = {PREFILTER_OVERVIEW: None, PREFILTER_MASK: [1]}.get(self.prefilter, [LANDCOVER_BAND])
+        tile_size = -(-size // factor)
+        shape = (
+            src.count if indexes is None else len(indexes),
+            tile_size,
+            -(-_buffer_width(tiles, size) // factor),
+        )
+        self._signal, signal = _scratch(self._signal, shape, np.uint8 if masks else src.dtypes[0])
+        _read_padded(src, batch_window, signal, indexes, factor, masks)
+
+        first = tiles[0][0]
+        starts = [(window.col_off - first.col_off) // factor for window, _ in tiles]
+        return [bool(signal[:, :, start:start + tile_size].any()) for start in starts]
+
+    def __iter__(self):
+        src, size = self.src, self.plan.size
+        for batch_window, tiles in get_tile_batches(src, self.plan):
+            if self.prefilter:
+                with report.timer("prefilter", items=len(tiles)):
+                    has_data = self._has_data(batch_window, tiles)
+                self.prefiltered_tiles += has_data.count(False)
+                tiles = [tile for tile, keep in zip(tiles, has_data) if keep]
+
+            for run in _contiguous_runs(tiles):
+                with report.timer("read", items=len(run)):
+                    self._run, buffer = _scratch(self._run, (src.count, size, _buffer_width(run, size)), src.dtypes[0])
+                    _read_padded(src, _batch_window(run), buffer)
+
+                for window, transform in run:
+                    start = window.col_off - run[0][0].col_off
+                    np.copyto(self.tile, buffer[:, :, start:start + size])
+                    # any() reduces in small chunks, with no full-size boolean temporary
+                    if not self.tile.any():
+                        self.empty_tiles += 1
+                        continue
+                    yield window, transform, self.tile
+
+    def is_flooded(self, tile):
+        """Same test as load_flooded_chips, into a reused mask."""
+        np.equal(tile[-1], 1, out=self._mask)
+        return bool(self._mask.any())
+
+
+class TileEncoder:
+    """
+    Encodes tiles of an open raster as GeoTIFFs, compressed and blocked as
+    set by the encoding (see ChipEncoding). The chip metadata is built once
+    per raster, and tiles are cast to the plan's dtype in a reused buffer.
+    Each chip still gets its own in-memory GDAL file and bytes object, which
+    the upload holds on to.
+    """
+
+    def __init__(self, src, plan=DEFAULT_PLAN, encoding=DEFAULT_ENCODING):
+        dtype = plan.dtype or src.dtypes[0]
+        self.meta = src.meta.copy()
+        self.meta.update({
+            "driver": "GTiff",
+            "height": plan.size,
+            "width": plan.size,
+            "dtype": dtype,
+        })
+        self.meta.update(encoding.creation_options(dtype, plan.size))
+        self._cast = None
+        if plan.dtype:
+            self._cast = np.empty((src.count, plan.size, plan.size), dtype=plan.dtype)
+
+    def cast(self, tile):
+        if self._cast is None or tile is self._cast:
+            return tile
+        np.copyto(self._cast, tile, casting="unsafe")
+        return self._cast
+
+    def encode(self, tile, transform):
+        self.meta["transform"] = transform
+        with MemoryFile() as tile_memfile:
+            with tile_memfile.open(**self.meta) as tile_dst:
+                tile_dst.write(self.cast(tile))
+            return tile_memfile.read()
+
+
+# Function to chip a single raster and upload its non-empty tiles, with their statistics
+def chip_raster(bucket, blob, output_path_prefix, engine=None, prefilter=None, keep_flooded=False, upload=True, chip_format=CHIP_FORMAT_TIF, plan=DEFAULT_PLAN, encoding=DEFAULT_ENCODING):
+    """
+    The raster is cut into tiles as laid out by the plan (see TilePlan) and
+    read with a TileReader. Tiles are handed to the transfer engine (the
+    shared one by default) as soon as they are encoded, so uploads overlap
+    with reading and encoding the next tiles.
+
+    With a prefilter (see PREFILTERS; None disables it), tiles the cheap
+    signal shows to be empty are dropped without reading their 16 bands.
+    Each prefilter can drop some tiles the full read would keep (see
+    PREFILTERS), so none is used by default. The tiles that pass are still
+    checked for data after the full read.
+
+    With keep_flooded, tiles that have flooded pixels are also returned as
+    a list of (chip file name, array), so they can be processed without
+    being downloaded and decoded again. upload=False skips encoding and
+    uploading the chips altogether.
+
+    Returns the flooded tiles and, for every chip uploaded, a row of
+    statistics (see chip_stats.tile_stats) computed while it is in memory.
+
+    chip_format "tif" writes one GeoTIFF object per chip; "shards" packs the
+    raster's chips into a few large shards with an index (see chip_shards).
+    Either way chips are GeoTIFFs written with the given encoding.
+    """
+    engine = engine or get_engine()
+    date = _chip_date(blob)
+    uploads = []
+    flooded = []
+    stats = []
+    shards = None
+    if upload and chip_format == CHIP_FORMAT_SHARDS:
+        shards = ShardWriter(bucket, output_path_prefix, date, engine=engine)
+
+    # Only the header is fetched here; each window's blocks are read on demand
+    start = time.perf_counter()
+    with open_raster(blob) as src:
+        report.add("open", time.perf_counter() - start, items=1)
+        reader = TileReader(src, plan, _choose_prefilter(src, prefilter))
+        encoder = TileEncoder(src, plan, encoding)
+
+        for window, transform, tile in reader:
+            filename = f"{date}_{window.col_off}_{window.row_off}.tif"
+            # Same test as load_flooded_chips, applied before any encoding
+            if keep_flooded and reader.is_flooded(tile):
+                flooded.append((filename, encoder.cast(tile).copy()))
+            if not upload:
+                continue
+
+            chip = encoder.cast(tile)
+            with report.timer("stats", items=1):
+                stats.append(dict(
+                    tile_stats(chip),
+                    key=filename[:-len(".tif")],
+                    date=date,
+                    col_off=window.col_off,
+                    row_off=window.row_off,
+                ))
+            with report.timer("encode", items=1):
+                tile_bytes = encoder.encode(chip, transform)
+
+            if shards is not None:
+                shards.add(
+                    filename[:-len(".tif")],
+                    tile_bytes,
+                    date=date,
+                    col_off=window.col_off,
+                    row_off=window.row_off,
+                    transform=list(transform)[:6],
+                    crs=src.crs.to_string() if src.crs else None,
+                )
+                continue
+            tile_blob = bucket.blob(os.path.join(output_path_prefix, filename))
+            uploads.append(engine.upload(tile_blob, tile_bytes, content_type='image/tiff'))
+
+    if shards is not None:
+        uploads.extend(shards.close())
+    wait_all(uploads)
+    # Tiles rejected by the prefilter are empty too, but never had a full read
+    report.add("empty_tiles", 0, items=reader.empty_tiles + reader.prefiltered_tiles)
+    report.add("full_reads_avoided", 0, items=reader.prefiltered_tiles)
+    print(f"Finished processing {blob.name}")
+    return flooded, stats
+
+
+# Entry point for worker processes: GCS bucket objects don't pickle, so only references are passed
+def _chip_raster_worker(bucket_ref, blob_name, output_path_prefix, scope, prefilter, keep_flooded, upload, chip_format, plan, encoding):
+    bucket = from_worker_ref(bucket_ref)
+    with report.scope(*scope):
+        chipped = chip_raster(
+            bucket,
+            bucket.get_blob(blob_name),
+            output_path_prefix,
+            prefilter=prefilter,
+            keep_flooded=keep_flooded,
+            upload=upload,
+            chip_format=chip_format,
+            plan=plan,
+            encoding=encoding,
+        )
+    # Send this worker's timings back to the parent's report
+    return chipped, report.drain()
+
+
+def _chip_date(blob):
+    # Extract date from the blob name; every chip of the raster starts with it
+    return blob.name.split('_')[-1].split('.')[0]
+
+
+def _source_record_blob(bucket, output_path_prefix, blob):
+    return bucket.blob(os.path.join(output_path_prefix, SOURCES_DIR, os.path.basename(blob.name) + ".json"))
+
+
+def _chipped_sources(bucket, output_path_prefix):
+    """Records of the rasters already chipped into output_path_prefix, by raster name."""
+    records = {}
+    for record_blob in bucket.list_blobs(prefix=os.path.join(output_path_prefix, SOURCES_DIR, "")):
+        record = json.loads(record_blob.download_as_bytes())
+        records[record["source"]] = record
+    return records
+
+
+def _record_source(bucket, output_path_prefix, blob, settings):
+    record = dict(settings, source=blob.name, generation=blob.generation, etag=getattr(blob, "etag", None))
+    _source_record_blob(bucket, output_path_prefix, blob).upload_from_string(
+        json.dumps(record), content_type="application/json"
+    )
+
+
+def _is_unchanged(record, blob, settings):
+    return (
+        record is not None
+        and record["generation"] == blob.generation
+        and all(record.get(key) == value for key, value in settings.items())
+    )
+
+
+def _delete_chips(bucket, output_path_prefix, blob):
+    # Clear the chips of an earlier version of the raster, so tiles that are
+    # empty in the new version don't linger
+    for chip_blob in bucket.list_blobs(prefix=os.path.join(output_path_prefix, _chip_date(blob))):
+        chip_blob.delete()
+
+
 # Function to process and save chipped tiles
-def make_chips(bucket_name, input_path_prefix, output_path_prefix):
-    client = storage.Client()
-    bucket = client.get_bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=input_path_prefix)
-
-    for blob in blobs:
-        if blob.name.endswith('.tif'):
-            data = blob.download_as_bytes()
-            # Extract date from the blob name
-            date = blob.name.split('_')[-1].split('.')[0]
-
-            with MemoryFile(data) as memfile:
-                with memfile.open() as src:
-                    for window, transform in get_tiles(src):
-                        # Ensure full 512x512 dimension by padding
-                        tile = src.read(window=window, boundless=True, fill_value=0)
-                        padded_tile = np.pad(tile, ((0, 0), (0, max(0, 512 - window.width)), (0, max(0, 512 - window.height))), mode='constant', constant_values=0)
-
-                        if np.any(padded_tile != 0):  # Check if there's any non-zero data in the tile
-                            meta = src.meta.copy()
-                            meta.update({
-                                "driver": "GTiff",
-                                "height": 512,
-                                "width": 512,
-                                "transform": transform
-                            })
-
-                            with MemoryFile() as tile_memfile:
-                                with tile_memfile.open(**meta) as tile_dst:
-                                    tile_dst.write(padded_tile)
-
-                                filename = f"{date}_{window.col_off}_{window.row_off}.tif"
-                                tile_blob = bucket.blob(os.path.join(output_path_prefix, filename))
-                                tile_blob.upload_from_string(tile_memfile.read(), content_type='image/tiff')
-
-            print(f"Finished processing {blob.name}")
+def make_chips(bucket, input_path_prefix, output_path_prefix, executor=None, prefilter=None, keep_flooded=False, upload=True, chip_format=CHIP_FORMAT_TIF, plan=DEFAULT_PLAN, incremental=True, encoding=DEFAULT_ENCODING):
+    """
+    Chip every raster under input_path_prefix into tiles as laid out by the
+    plan (512x512 without overlap by default), and save the plan with them.
+
+    If a process pool executor is given, each raster is decoded, tiled and
+    encoded in a worker process, so chipping uses more than one core; otherwise
+    the rasters are chipped one after the other in the calling thread.
+    prefilter, keep_flooded, upload, chip_format, plan and encoding are passed on to chip_raster. With
+    keep_flooded, the flooded tiles of all rasters are returned in the order
+    process_chips would list their chip files.
+
+    Once a raster's chips are uploaded, its generation, etag and the chip
+    settings are recorded next to the chips. With incremental, rasters whose
+    generation and settings match their record are skipped, so only new or
+    modified rasters are chipped. keep_flooded needs the tiles of every
+    raster, so it always chips them all.
+
+    The statistics of every chip go into a Parquet sidecar next to the chips
+    (see chip_stats), where those of rasters chipped in earlier runs are kept.
+    A raster's statistics are merged into it before its record is written,
+    so a raster that is skipped on a rerun always has current statistics.
+    """
+    blobs = [blob for blob in bucket.list_blobs(prefix=input_path_prefix) if blob.name.endswith('.tif')]
+
+    settings = {"plan": plan.to_dict(), "chip_format": chip_format, "prefilter": prefilter, "encoding": encoding.to_dict()}
+    if upload:
+        save_plan(bucket, output_path_prefix, plan)
+        if incremental and not keep_flooded:
+            records = _chipped_sources(bucket, output_path_prefix)
+            changed = [blob for blob in blobs if not _is_unchanged(records.get(blob.name), blob, settings)]
+            report.add("sources_skipped", 0, items=len(blobs) - len(changed))
+            if len(changed) < len(blobs):
+                print(f"Skipping {len(blobs) - len(changed)} rasters chipped in an earlier run")
+            for blob in changed:
+                if blob.name in records:
+                    _delete_chips(bucket, output_path_prefix, blob)
+            blobs = changed
+
+    def finish(blob, raster_stats):
+        if not upload:
+            return
+        with report.timer("save_stats", items=len(raster_stats)):
+            write_chip_stats(bucket, output_path_prefix, raster_stats, {_chip_date(blob)})
+        _record_source(bucket, output_path_prefix, blob, settings)
+
+    flooded = []
+    if executor is None:
+        for blob in blobs:
+            raster_flooded, raster_stats = chip_raster(bucket, blob, output_path_prefix, prefilter=prefilter, keep_flooded=keep_flooded, upload=upload, chip_format=chip_format, plan=plan, encoding=encoding)
+            flooded.extend(raster_flooded)
+            finish(blob, raster_stats)
+    else:
+        futures = {
+            executor.submit(_chip_raster_worker, to_worker_ref(bucket), blob.name, output_path_prefix, report.current_scope(), prefilter, keep_flooded, upload, chip_format, plan, encoding): blob
+            for blob in blobs
+        }
+        for future in as_completed(futures):
+            (raster_flooded, raster_stats), records = future.result()  # Also re-raises any error from the worker
+            report.merge(records)
+            flooded.extend(raster_flooded)
+            finish(futures[future], raster_stats)
 
+    flooded.sort(key=lambda chip: chip[0])
+    return flooded
@@ -1,15 +1,17 @@
 import os
 from datetime import datetime, timedelta
 import ee
-from google.cloud import storage
 from dotenv import load_dotenv
 import re
+import time
 
 
 from utils.pygeoboundaries import get_adm_ee
 from utils.filter_emdat import filter_data_from_gcs
 from utils.export_and_monitor import start_export_task
 from utils.monitor_tasks import monitor_tasks
+from utils.run_manifest import DONE, EMPTY, FAILED, fingerprint
+from utils.run_report import report
 
 
 # Load and retrieve environment variables
@@ -234,7 +236,7 @@ def extract_date_from_filename(filename):
 
 
 def check_and_export_geotiffs_to_bucket(
-    bucket, fileNamePrefix, flood_dates, bbox, scale=90
+    bucket, fileNamePrefix, flood_dates, bbox, scale=90, manifest=None, country=None
 ):
     # No need to initialize storage_client or retrieve the bucket here
     existing_files = list(bucket.list_blobs(prefix=fileNamePrefix))
@@ -245,10 +247,24 @@ def check_and_export_geotiffs_to_bucket(
     ]
 
     tasks = []
+    task_events = {}
+    submit_start = time.perf_counter()
 
     for index, (start_date, end_date) in enumerate(flood_dates):
-        if start_date.strftime("%Y-%m-%d") in existing_dates:
+        event = start_date.strftime("%Y-%m-%d")
+        event_fingerprint = fingerprint(start_date, end_date, scale)
+
+        if event in existing_dates:
             print(f"Skipping {start_date}: data already exist")
+            if manifest is not None:
+                manifest.record(country, "export", event_fingerprint, DONE, event)
+            continue
+
+        # Events without imagery are recorded too, so reruns don't query them again
+        if manifest is not None and manifest.is_done(
+            country, "export", event_fingerprint, event
+        ):
+            print(f"Skipping {start_date}: already handled in a previous run")
             continue
 
         training_data_result = make_training_data(bbox, start_date, end_date)
@@ -256,6 +272,8 @@ def check_and_export_geotiffs_to_bucket(
             print(
                 f"Skipping export for {start_date} to {end_date}: No imagery available."
             )
+            if manifest is not None:
+                manifest.record(country, "export", event_fingerprint, EMPTY, event)
             continue
 
         geotiff = training_data_result.toShort()
@@ -269,10 +287,18 @@ def check_and_export_geotiffs_to_bucket(
             geotiff, export_description, bucket.name, specificFileNamePrefix, scale
         )
         tasks.append(task)
+        task_events[task.id] = (event, event_fingerprint)
+
+    report.add("export_submit", time.perf_counter() - submit_start, items=len(tasks))
 
     if tasks:
         print("All exports initiated, monitoring task status...")
-        monitor_tasks(tasks)
+        with report.timer("export_wait", items=len(tasks)):
+            final_states = monitor_tasks(tasks)
+        if manifest is not None:
+            for task_id, (event, event_fingerprint) in task_events.items():
+                status = DONE if final_states.get(task_id) == "COMPLETED" else FAILED
+                manifest.record(country, "export", event_fingerprint, status, event)
     else:
         print("No exports were initiated.")
 
@@ -281,8 +307,8 @@ def check_and_export_geotiffs_to_bucket(
     )
 
 
-def make_raw_dat(place_name, bucket, path):
-    
+def make_raw_dat(place_name, bucket, path, manifest=None, emdat_events=None):
+
     # Check if place_name is a string
     if not isinstance(place_name, str):
         return "Error: Place name must be a string in quotation marks."
@@ -290,7 +316,7 @@ def make_raw_dat(place_name, bucket, path):
     aoi = get_adm_ee(territories=place_name, adm="ADM0")
     bbox = aoi.geometry().bounds()
 
-    date_pairs = filter_data_from_gcs(place_name)
+    date_pairs = filter_data_from_gcs(place_name, emdat_events=emdat_events)
     print(f"Date pairs from filter_data_from_gcs: {date_pairs}")  # Debugging print
 
     # Prepare date pairs for processing
@@ -310,5 +336,7 @@ def make_raw_dat(place_name, bucket, path):
         "", content_type="application/x-www-form-urlencoded;charset=UTF-8"
     )  # Create the directory
 
-    check_and_export_geotiffs_to_bucket(bucket, path, flood_dates, bbox)
+    check_and_export_geotiffs_to_bucket(
+        bucket, path, flood_dates, bbox, manifest=manifest, country=place_name
+    )
 
@@ -3,8 +3,15 @@ import ee
 
 
 def monitor_tasks(tasks):
+    """
+    Poll Earth Engine until every task has finished.
+
+    Returns:
+    - A dict mapping each task id to its final state (COMPLETED, FAILED or CANCELLED)
+    """
     print("Monitoring tasks...")
     completed_tasks = set()
+    final_states = {}
     while len(completed_tasks) < len(tasks):
         for task in tasks:
             # Skip already completed tasks
@@ -27,6 +34,7 @@ def monitor_tasks(tasks):
                         print(f"Task {task.id} was cancelled.")
 
                     completed_tasks.add(task.id)
+                    final_states[task.id] = state
                 else:
                     # Task is still running; print its current state for monitoring
                     print(f"Task {task.id} is {state}.")
@@ -41,3 +49,4 @@ def monitor_tasks(tasks):
         )  # Adjust the sleep time as needed based on your task's average completion time
 
     print("All tasks have been processed.")
+    return final_states
@@ -1,112 +1,607 @@
 from dotenv import load_dotenv
 
+import json
 import os
 import numpy as np
-from rasterio.io import MemoryFile
-from google.cloud import storage
 import tempfile
 import warnings
+from collections import deque
+from functools import partial
+
+from rasterio.io import MemoryFile
+
+from utils.chip_shards import is_shard_index, read_index, split_shard
+from utils.chip_stats import chips_without_floods, load_chip_stats
+from utils.landcover import LandcoverEncoder
+from utils.processed_data import (
+    IMAGES_FILE_NAME,
+    LANDCOVER_FILE_NAME,
+    LAYOUT_INDEX,
+    LAYOUT_ONEHOT,
+    MASKS_FILE_NAME,
+    METADATA_FILE_NAME,
+    PRECISION_FLOAT64,
+    dequantize,
+    precision_metadata,
+    quantize,
+)
+from utils.run_report import report
+from utils.storage_backend import from_worker_ref, to_worker_ref
+from utils.tile_plan import DEFAULT_PLAN, load_plan
+from utils.transfer import get_engine
 
 # Load environment variables
 load_dotenv()
 cloud_project = os.getenv("GOOGLE_CLOUD_PROJECT_NAME")
 key_path = os.getenv("GOOGLE_CLOUD_KEY_PATH")
 
-os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
+if key_path:
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = key_path
 os.environ["GDAL_DISABLE_READDIR_ON_OPEN"] = "YES"
 os.environ["CPL_VSIL_CURL_ALLOWED_EXTENSIONS"] = "tif"
 
-# Initialize Google Cloud Storage client
-client = storage.Client(project=cloud_project)
+# Batches decoded by worker processes ahead of the one being streamed
+STREAM_BATCHES_IN_FLIGHT = 2
+# Chips per batch encoded, scaled and written by a worker process
+WRITE_BATCH_SIZE = 16
 
-def process_chips(bucket, input_path_prefix, output_path_prefix, encoder=None):
-    blobs = bucket.list_blobs(prefix=input_path_prefix)
+# Function to download chips and keep the ones containing flooded pixels
+def load_flooded_chips(bucket, blobs, engine=None, plan=DEFAULT_PLAN):
+    """
+    Chips are downloaded through the transfer engine (the shared one by
+    default), many at a time and ahead of decoding. Chips that don't match
+    the plan they were made with are skipped.
+    """
+    engine = engine or get_engine()
     arrays = []
     masks_to_save = []
 
-    for blob in blobs:
-        if blob.name.endswith('.tif'):
-            #print(f"Processing blob: {blob.name}")
-            with MemoryFile(blob.download_as_bytes()) as memfile:
+    for blob, data in engine.download_many(blobs):
+        #print(f"Processing blob: {blob.name}")
+        with report.timer("decode", items=1):
+            with MemoryFile(data) as memfile:
                 with memfile.open(driver='GTiff') as src:
                     array = src.read()
-                    # Check and ensure the array dimensions
-                    if array.shape[1] != 512 or array.shape[2] != 512:
-                        print(f"Skipping file {blob.name}, incorrect dimensions {array.shape}")
-                        continue
-                    # Check if the mask has any flooded pixels
-                    mask = array[-1, :, :]
-                    if np.any(mask == 1):
-                        arrays.append(array)
-                        masks_to_save.append(mask)
+        if not _matches_plan(array, plan):
+            print(f"Skipping file {blob.name}, {array.shape} {array.dtype} doesn't match {plan}")
+            continue
+        # Check if the mask has any flooded pixels
+        mask = array[-1, :, :]
+        if np.any(mask == 1):
+            arrays.append(array)
+            masks_to_save.append(mask)
+
+    return arrays, masks_to_save
+
+
+# Function to read chips stored in shards and keep the ones containing flooded pixels
+def _matches_plan(array, plan):
+    return array.shape[1:] == (plan.size, plan.size) and (plan.dtype is None or array.dtype == plan.dtype)
+
+
+def load_flooded_shard_chips(bucket, index_blobs, engine=None, plan=DEFAULT_PLAN, skip_keys=()):
+    """
+    Each shard is downloaded whole, in one sequential transfer, and split
+    into its chips using its index. Returns the keys of the flooded chips
+    along with their arrays and masks. Chips whose keys are in skip_keys
+    are known to have no flooded pixels; they aren't decoded, and shards
+    holding only such chips aren't downloaded.
+    """
+    engine = engine or get_engine()
+    indexes = [
+        [entry for entry in read_index(blob) if entry["key"] not in skip_keys]
+        for blob in index_blobs
+    ]
+    indexes = [entries for entries in indexes if entries]
+    shard_blobs = [bucket.blob(entries[0]["shard"]) for entries in indexes]
+    keys = []
+    arrays = []
+    masks_to_save = []
+
+    for entries, (_, data) in zip(indexes, engine.download_many(shard_blobs)):
+        for entry, chip in split_shard(data, entries):
+            with report.timer("decode", items=1):
+                with MemoryFile(chip) as memfile:
+                    with memfile.open(driver='GTiff') as src:
+                        array = src.read()
+            if not _matches_plan(array, plan):
+                print(f"Skipping chip {entry['key']}, {array.shape} {array.dtype} doesn't match {plan}")
+                continue
+            mask = array[-1, :, :]
+            if np.any(mask == 1):
+                keys.append(entry["key"])
+                arrays.append(array)
+                masks_to_save.append(mask)
+
+    return keys, arrays, masks_to_save
+
+
+# Entry points for worker processes: GCS bucket objects don't pickle, so only references are passed
+def _load_flooded_chips_worker(bucket_ref, blob_names, scope, plan):
+    bucket = from_worker_ref(bucket_ref)
+    with report.scope(*scope):
+        chips = load_flooded_chips(bucket, [bucket.blob(name) for name in blob_names], plan=plan)
+    # Send this worker's timings back to the parent's report
+    return chips, report.drain()
+
+
+def _load_flooded_shard_chips_worker(bucket_ref, index_names, scope, plan, skip_keys):
+    bucket = from_worker_ref(bucket_ref)
+    with report.scope(*scope):
+        chips = load_flooded_shard_chips(bucket, [bucket.blob(name) for name in index_names], plan=plan, skip_keys=skip_keys)
+    return chips, report.drain()
+
+
+def _load_from_shards(bucket, index_blobs, plan, executor=None, skip_keys=()):
+    if executor is None:
+        keys, arrays, masks_to_save = load_flooded_shard_chips(bucket, index_blobs, plan=plan, skip_keys=skip_keys)
+    else:
+        # A shard is a few hundred MB, so each worker task handles one
+        futures = [
+            executor.submit(_load_flooded_shard_chips_worker, to_worker_ref(bucket), [blob.name], report.current_scope(), plan, skip_keys)
+            for blob in index_blobs
+        ]
+        keys, arrays, masks_to_save = [], [], []
+        for future in futures:
+            (shard_keys, shard_arrays, shard_masks), records = future.result()
+            report.merge(records)
+            keys.extend(shard_keys)
+            arrays.extend(shard_arrays)
+            masks_to_save.extend(shard_masks)
+
+    # Chips in the order their files would be listed, as for GeoTIFF chips
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    return [arrays[i] for i in order], [masks_to_save[i] for i in order]
 
+
+def process_chips(bucket, input_path_prefix, output_path_prefix, encoder=None, executor=None, batch_size=256, streaming=False, layout=LAYOUT_ONEHOT, precision=PRECISION_FLOAT64):
+    """
+    Turn the chips of a country into model-ready image and mask arrays.
+
+    If a process pool executor is given, chips are downloaded, decoded and
+    filtered in batches of batch_size in worker processes, and encoded,
+    scaled and written in smaller batches there too; otherwise this all
+    happens in the calling thread. Chips stored in shards (see chip_shards)
+    are read a shard at a time, and take precedence over GeoTIFF chips
+    under the same prefix. Chips are checked against the tile plan saved
+    with them.
+
+    Chips that the statistics sidecar written by make_chips (see chip_stats)
+    shows to have no flooded pixels are not downloaded at all. Chips it
+    doesn't cover, e.g. made before it existed, are checked as before.
+
+    By default all flooded chips are downloaded into memory before they
+    are processed. With streaming, they are processed in two passes over one batch at a
+    time (see process_streaming), so memory use doesn't grow with the
+    number of chips; the output is the same.
+
+    layout sets how landcover is stored (see processed_data.LAYOUTS), and
+    precision the dtype of the scaled images (see processed_data.PRECISIONS).
+    """
+    plan = load_plan(bucket, input_path_prefix)
+    skip_keys = chips_without_floods(load_chip_stats(bucket, input_path_prefix))
+    all_blobs = list(bucket.list_blobs(prefix=input_path_prefix))
+    index_blobs = [blob for blob in all_blobs if is_shard_index(blob)]
+    blobs = [
+        blob for blob in all_blobs
+        if blob.name.endswith('.tif') and os.path.basename(blob.name)[:-len('.tif')] not in skip_keys
+    ]
+    report.add("chips_skipped", 0, items=len(skip_keys))
+
+    if streaming:
+        batches = _flooded_batches(bucket, blobs, index_blobs, plan, executor, skip_keys, batch_size)
+        process_streaming(bucket, batches, output_path_prefix, encoder, layout, precision, executor)
+        return
+
+    if index_blobs:
+        arrays, masks_to_save = _load_from_shards(bucket, index_blobs, plan, executor, skip_keys)
+    elif executor is None:
+        arrays, masks_to_save = load_flooded_chips(bucket, blobs, plan=plan)
+    else:
+        names = [blob.name for blob in blobs]
+        futures = [
+            executor.submit(_load_flooded_chips_worker, to_worker_ref(bucket), names[start:start + batch_size], report.current_scope(), plan)
+            for start in range(0, len(names), batch_size)
+        ]
+        arrays = []
+        masks_to_save = []
+        # Collect in submission order so the output is the same as a serial run
+        for future in futures:
+            (batch_arrays, batch_masks), records = future.result()
+            report.merge(records)
+            arrays.extend(batch_arrays)
+            masks_to_save.extend(batch_masks)
+
+    process_arrays(bucket, arrays, masks_to_save, output_path_prefix, encoder, layout, precision, executor)
+
+
+def process_arrays(bucket, arrays, masks_to_save, output_path_prefix, encoder=None, layout=LAYOUT_ONEHOT, precision=PRECISION_FLOAT64, executor=None):
+    """
+    Encode, scale and save chips that are already in memory: arrays holds
+    each chip's bands and masks_to_save its flood mask. The chips aren't
+    stacked; each is written to its slot of the output as it is processed,
+    in worker processes if a process pool executor is given (see
+    _save_processed).
+    """
     if arrays:
         num_bands, height, width = arrays[0].shape
-        num_files = len(arrays)
-        print(f"Found {num_files} files with shape {num_bands} bands, {height}x{width} pixels.")
-
-        all_arrays = np.stack(arrays, axis=0)
-        masks = np.stack(masks_to_save, axis=0)
-
-        # Process and encode the data
-        landcover_data = all_arrays[:, 1, :, :].reshape(-1, 1)
-        if encoder is None:
-            from sklearn.preprocessing import OneHotEncoder
-            encoder = OneHotEncoder(sparse_output=False)
-        landcover_encoded = encoder.fit_transform(landcover_data).reshape(num_files, height, width, -1)
-        landcover_encoded = np.transpose(landcover_encoded, (0, 3, 1, 2))
-        print("Data encoding complete.")
-
-        # Excluding specific bands
-        all_arrays = np.delete(all_arrays, [1, -1], axis=1)
-
-        # Scaling
-        min_vals = np.nanmin(all_arrays, axis=(0, 2, 3))
-        max_vals = np.nanmax(all_arrays, axis=(0, 2, 3))
-        
-        # Ensure min and max are broadcastable to the shape of all_arrays
-        min_vals = min_vals[:, np.newaxis, np.newaxis]
-        max_vals = max_vals[:, np.newaxis, np.newaxis]
-        
-        # Calculate the range and adjust zeros before any division attempt
-        range_vals = max_vals - min_vals
-        small_value = 1e-10
-        range_vals[range_vals == 0] = small_value  # Prevent division by zero
-
-        # Normalize the data
-        try:
-            all_arrays = (all_arrays - min_vals) / range_vals
-            print("Data scaling complete.")
-        except RuntimeWarning:
-            print("Unexpected issue occurred during scaling.")
-
-        # Concatenate scaled images with encoded land cover
-        all_arrays = np.concatenate([all_arrays, landcover_encoded], axis=1)
-        masks = masks[:, np.newaxis, :, :]
-
-        print("Data concatenation complete. Saving processed data...")
-        save_to_gcs(bucket, all_arrays, masks, output_path_prefix, 'processed_data/images.npy', 'processed_data/masks.npy')
-        print("Data saved successfully.")
-        
+        print(f"Found {len(arrays)} files with shape {num_bands} bands, {height}x{width} pixels.")
+        summary = _ChipSummary()
+        for array in arrays:
+            summary.add(array)
+        _save_processed(bucket, zip(arrays, masks_to_save), summary, output_path_prefix, encoder, layout, precision, executor)
+
+
+def _scaling(min_vals, max_vals):
+    """Per-band offsets and ranges that scale chips to [0, 1], broadcastable to bands x height x width."""
+    min_vals = min_vals[:, np.newaxis, np.newaxis]
+    max_vals = max_vals[:, np.newaxis, np.newaxis]
+
+    # Calculate the range and adjust zeros before any division attempt
+    range_vals = max_vals - min_vals
+    small_value = 1e-10
+    range_vals[range_vals == 0] = small_value  # Prevent division by zero
+    return min_vals, range_vals
+
+
+def _flooded_batches(bucket, blobs, index_blobs, plan, executor, skip_keys, batch_size):
+    """
+    Yield the flooded chips a batch at a time as (keys, arrays): a shard per
+    batch with its chips' keys, or batch_size GeoTIFF chips in listing order
+    with keys None. With an executor, at most STREAM_BATCHES_IN_FLIGHT
+    batches are decoded ahead of the one being consumed.
+    """
+    if executor is None:
+        if index_blobs:
+            for blob in index_blobs:
+                keys, arrays, _ = load_flooded_shard_chips(bucket, [blob], plan=plan, skip_keys=skip_keys)
+                yield keys, arrays
+        else:
+            for start in range(0, len(blobs), batch_size):
+                arrays, _ = load_flooded_chips(bucket, blobs[start:start + batch_size], plan=plan)
+                yield None, arrays
+        return
+
+    bucket_ref = to_worker_ref(bucket)
+    scope = report.current_scope()
+    if index_blobs:
+        submits = [
+            partial(executor.submit, _load_flooded_shard_chips_worker, bucket_ref, [blob.name], scope, plan, skip_keys)
+            for blob in index_blobs
+        ]
+    else:
+        names = [blob.name for blob in blobs]
+        submits = [
+            partial(executor.submit, _load_flooded_chips_worker, bucket_ref, names[start:start + batch_size], scope, plan)
+            for start in range(0, len(names), batch_size)
+        ]
+
+    def collect(future):
+        chips, records = future.result()
+        report.merge(records)
+        return (chips[0], chips[1]) if index_blobs else (None, chips[0])
+
+    pending = deque()
+    for submit in submits:
+        pending.append(submit())
+        if len(pending) > STREAM_BATCHES_IN_FLIGHT:
+            yield collect(pending.popleft())
+    while pending:
+        yield collect(pending.popleft())
+
 
-def save_to_gcs(bucket, images_array, masks_array, output_path_prefix, images_blob_name, masks_blob_name):
-    """Helper function to save arrays to GCS using temporary files."""
-    with tempfile.NamedTemporaryFile(delete=False) as images_temp, tempfile.NamedTemporaryFile(delete=False) as masks_temp:
-        np.save(images_temp, images_array)
-        np.save(masks_temp, masks_array)
+class _ChipSummary:
+    """
+    What processing needs to know about all the chips before it writes any:
+    their number, shape and dtype, and the per-band min and max.
+    """
 
-        images_temp.close()
-        masks_temp.close()
+    def __init__(self):
+        self.count = 0
+        self.shape = None
+        self.dtype = None
+        self.min_vals = None
+        self.max_vals = None
 
-        images_blob = bucket.blob(f"{output_path_prefix}/{images_blob_name}")
-        masks_blob = bucket.blob(f"{output_path_prefix}/{masks_blob_name}")
+    def add(self, array):
+        if self.shape is None:
+            self.shape, self.dtype = array.shape, array.dtype
+            self.min_vals = np.nanmin(array, axis=(1, 2))
+            self.max_vals = np.nanmax(array, axis=(1, 2))
+        else:
+            self.min_vals = np.fmin(self.min_vals, np.nanmin(array, axis=(1, 2)))
+            self.max_vals = np.fmax(self.max_vals, np.nanmax(array, axis=(1, 2)))
+        self.count += 1
 
-        images_blob.upload_from_filename(images_temp.name, content_type='application/octet-stream')
-        masks_blob.upload_from_filename(masks_temp.name, content_type='application/octet-stream')
 
-        # Remove the temporary files after uploading
-        os.remove(images_temp.name)
-        os.remove(masks_temp.name)
+class _ChipSpill(_ChipSummary):
+    """
+    Pass one of process_streaming: flooded chips are summarised and
+    appended as they come to a raw file on local disk.
+    """
 
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.keys = []
+        self._file = open(path, "wb")
+
+    def add_batch(self, keys, arrays):
+        for array in arrays:
+            self.add(array)
+            self._file.write(np.ascontiguousarray(array, dtype=self.dtype).data)
+        if keys is not None:
+            self.keys.extend(keys)
+
+    def chips(self):
+        """
+        Yield the spilled chips in the order process_chips stacks them, read
+        one at a time into the same buffer. Shard chips arrive a shard at a
+        time, so they are put back in key order.
+        """
+        self._file.close()
+        order = sorted(range(self.count), key=self.keys.__getitem__) if self.keys else range(self.count)
+        chip = np.empty(self.shape, dtype=self.dtype)
+        with open(self.path, "rb") as f:
+            for index in order:
+                f.seek(index * chip.nbytes)
+                f.readinto(chip)
+                yield chip
+
+
+def process_streaming(bucket, batches, output_path_prefix, encoder=None, layout=LAYOUT_ONEHOT, precision=PRECISION_FLOAT64, executor=None):
+    """
+    Encode, scale and save flooded chips that arrive in batches of (keys,
+    arrays), with the same result as process_arrays but without holding
+    more than a batch in memory.
+
+    Pass one spills the chips to local disk and accumulates the per-band
+    min and max. Pass two reads the spilled chips back one at a time and
+    writes each to the output (see _save_processed).
+    """
+    with tempfile.TemporaryDirectory(prefix="process_chips_") as workdir:
+        spill = _ChipSpill(os.path.join(workdir, "chips.raw"))
+        for keys, arrays in batches:
+            spill.add_batch(keys, arrays)
+        if not spill.count:
+            return
+        num_bands, height, width = spill.shape
+        print(f"Found {spill.count} files with shape {num_bands} bands, {height}x{width} pixels.")
+        _save_processed(bucket, ((chip, chip[-1]) for chip in spill.chips()), spill, output_path_prefix, encoder, layout, precision, executor)
+
+
+class _NpyOutput:
+    """
+    A .npy file on local disk, preallocated with open_memmap for an array of
+    dtype and shape, whose items are written in place one at a time.
+
+    Items are written through the file rather than the memory map, which
+    would keep every page written resident in the process. The file is
+    opened on first write, so a pickled copy sent to a worker process writes
+    to the same file through its own handle.
+    """
+
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        array = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=shape)
+        self._offset = array.offset
+        self._item_bytes = array[0].nbytes
+        del array
+        self._file = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _file=None)
+
+    def write(self, index, *parts):
+        """Write item index, given as parts that follow each other along its first axis."""
+        if self._file is None:
+            self._file = open(self.path, "r+b")
+        self._file.seek(self._offset + index * self._item_bytes)
+        for part in parts:
+            self._file.write(np.ascontiguousarray(part, dtype=self.dtype).data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _ChipWriter:
+    """
+    Encodes the landcover of chips, scales and stores their kept bands in
+    the output precision, and writes them to their slots of the output
+    files (see _save_processed). max_error is the largest difference
+    between a stored value and the exact scaled one so far.
+
+    It holds only the scaling and the output files' layout, so a copy can be
+    sent to a worker process to write a batch of chips there.
+    """
+
+    def __init__(self, outputs, encoder, layout, images_metadata, kept_bands, min_vals, range_vals):
+        self.outputs = outputs
+        self.encoder = encoder
+        self.layout = layout
+        self.images_metadata = images_metadata
+        self.kept_bands = kept_bands
+        self.min_vals = min_vals
+        self.range_vals = range_vals
+        # What the 0 and 1 of one-hot landcover are stored as
+        self.one_hot_values = quantize(np.array([0.0, 1.0]), images_metadata)
+        self.max_error = 0.0
+        self._landcover_encoded = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _landcover_encoded=None)
+
+    def write(self, index, chip, mask):
+        if self._landcover_encoded is None:
+            if self.layout == LAYOUT_INDEX:
+                self._landcover_encoded = np.empty((1, *chip.shape[1:]), dtype=np.uint8)
+            else:
+                self._landcover_encoded = np.empty((self.encoder.num_channels, *chip.shape[1:]), dtype=self.encoder.dtype)
+        landcover_encoded = self._landcover_encoded
+
+        with report.timer("encode", items=1):
+            if self.layout == LAYOUT_INDEX:
+                self.encoder.index(chip[1], out=landcover_encoded[0])
+            else:
+                self.encoder.encode(chip[1], out=landcover_encoded)
+        with report.timer("scale", items=1):
+            scaled = (chip[self.kept_bands] - self.min_vals) / self.range_vals
+        with report.timer("quantize", items=1):
+            stored = quantize(scaled, self.images_metadata)
+            if stored is not scaled:
+                error = np.abs(dequantize(stored, self.images_metadata, np.float64) - scaled)
+                self.max_error = np.fmax(self.max_error, np.fmax.reduce(error, axis=None))
+
+        if self.layout == LAYOUT_INDEX:
+            self.outputs[IMAGES_FILE_NAME].write(index, stored)
+            self.outputs[LANDCOVER_FILE_NAME].write(index, landcover_encoded)
+        else:
+            # Scaled images followed by encoded land cover
+            self.outputs[IMAGES_FILE_NAME].write(index, stored, np.take(self.one_hot_values, landcover_encoded))
+        self.outputs[MASKS_FILE_NAME].write(index, mask)
+
+    def close(self):
+        for output in self.outputs.values():
+            output.close()
+
+
+def _write_chips_worker(writer, start, chips, scope):
+    """Write chips, given as (chip, mask), to the slots from start on; entry point for worker processes."""
+    with report.scope(*scope):
+        for index, (chip, mask) in enumerate(chips, start):
+            writer.write(index, chip, mask)
+    writer.close()
+    return writer.max_error, report.drain()
+
+
+def _write_in_workers(executor, writer, chips):
+    """
+    Write chips, given as (chip, mask) in output order, with copies of
+    writer in worker processes, WRITE_BATCH_SIZE chips per task and at most
+    STREAM_BATCHES_IN_FLIGHT tasks queued ahead. Returns the largest error.
+    """
+    scope = report.current_scope()
+    max_error = 0.0
+    pending = deque()
+    batch = []
+    start = 0
+
+    def submit():
+        nonlocal max_error
+        pending.append(executor.submit(_write_chips_worker, writer, start, batch, scope))
+        if len(pending) > STREAM_BATCHES_IN_FLIGHT:
+            max_error = np.fmax(max_error, collect(pending.popleft()))
+
+    def collect(future):
+        error, records = future.result()
+        report.merge(records)
+        return error
+
+    for index, (chip, mask) in enumerate(chips):
+        # Copied, as chips may be views of a buffer reused for the next ones
+        batch.append((np.array(chip), np.array(mask)))
+        if len(batch) == WRITE_BATCH_SIZE:
+            submit()
+            batch, start = [], index + 1
+    if batch:
+        submit()
+    while pending:
+        max_error = np.fmax(max_error, collect(pending.popleft()))
+    return max_error
+
+
+def _save_processed(bucket, chips, summary, output_path_prefix, encoder=None, layout=LAYOUT_ONEHOT, precision=PRECISION_FLOAT64, executor=None):
+    """
+    Scale and encode chips, given as (chip, mask) in output order, into
+    processed_data/images.npy and masks.npy under output_path_prefix, with
+    a metadata.json describing them.
+
+    Once summary has seen every chip, the output files are preallocated on
+    local disk for summary.count chips, and each chip is written to its slot
+    as soon as it is processed, so only one processed chip is in memory at a
+    time. With a process pool executor, chips are encoded, scaled and
+    written in batches by worker processes instead (see _write_in_workers).
+    The finished files are uploaded as they are; np.load(path,
+    mmap_mode='r') reads them lazily, a chip at a time, and
+    processed_data.iter_batches reads them in batches.
+
+    Landcover is encoded by encoder, a LandcoverEncoder over the WorldCover
+    classes by default, so the channels are the same for every country.
+    With the one-hot layout its channels follow the scaled bands in
+    images.npy, in its dtype. With the index layout, landcover.npy holds a
+    uint8 class index per pixel instead, one byte per pixel rather than one
+    value per class, which processed_data expands when the data is loaded.
+
+    images.npy is stored in precision: float64, as the scaling computes it,
+    a narrower float, or quantized to uint16 or uint8 levels with the scale
+    and offset to convert them back recorded in metadata.json. Its size and
+    largest error against float64 are noted in the run report.
+    """
+    num_bands, height, width = summary.shape
+    encoder = encoder or LandcoverEncoder()
+    images_metadata = precision_metadata(precision)
+
+    # Excluding specific bands
+    kept_bands = np.delete(np.arange(num_bands), [1, -1])
+    min_vals, range_vals = _scaling(summary.min_vals[kept_bands], summary.max_vals[kept_bands])
+
+    with tempfile.TemporaryDirectory(prefix="processed_data_") as workdir:
+        outputs = _open_outputs(workdir, layout, summary, len(kept_bands), encoder, images_metadata)
+        writer = _ChipWriter(outputs, encoder, layout, images_metadata, kept_bands, min_vals, range_vals)
+        if executor is None:
+            for index, (chip, mask) in enumerate(chips):
+                writer.write(index, chip, mask)
+            max_error = writer.max_error
+        else:
+            max_error = _write_in_workers(executor, writer, chips)
+        writer.close()
+        print("Data encoding and scaling complete. Saving processed data...")
+
+        images = outputs[IMAGES_FILE_NAME]
+        images_bytes = os.path.getsize(images.path)
+        report.note(
+            "precision",
+            dtype=images.dtype.name,
+            images_bytes=images_bytes,
+            float64_bytes=int(np.prod(images.shape)) * 8,
+            max_error=float(max_error),
+        )
+
+        metadata = {
+            "layout": layout,
+            "landcover_classes": encoder.classes,
+            "chips": summary.count,
+            **images_metadata,
+            "max_error": float(max_error),
+        }
+        paths = [output.path for output in outputs.values()] + [os.path.join(workdir, METADATA_FILE_NAME)]
+        with open(paths[-1], "w") as f:
+            json.dump(metadata, f)
+
+        with report.timer("save", items=len(paths)) as step:
+            for path in paths:
+                step.bytes += os.path.getsize(path)
+                bucket.blob(f"{output_path_prefix}/processed_data/{os.path.basename(path)}").upload_from_filename(
+                    path, content_type='application/octet-stream'
+                )
+        print("Data saved successfully.")
 
 
+def _open_outputs(workdir, layout, summary, num_kept_bands, encoder, images_metadata):
+    """The output files for the chips of summary, by file name."""
+    _, height, width = summary.shape
+    outputs = {}
+    if layout == LAYOUT_INDEX:
+        outputs[IMAGES_FILE_NAME] = (images_metadata["dtype"], num_kept_bands)
+        outputs[LANDCOVER_FILE_NAME] = (np.uint8, 1)
+    else:
+        outputs[IMAGES_FILE_NAME] = (images_metadata["dtype"], num_kept_bands + encoder.num_channels)
+    outputs[MASKS_FILE_NAME] = (summary.dtype, 1)
+    return {
+        name: _NpyOutput(os.path.join(workdir, name), dtype, (summary.count, channels, height, width))
+        for name, (dtype, channels) in outputs.items()
+    }
@@ -0,0 +1,124 @@
+import json
+import os
+
+import numpy as np
+
+# How process_chips stores landcover
+LAYOUT_ONEHOT = "onehot"  # One-hot channels after the scaled bands in images.npy
+LAYOUT_INDEX = "index"  # A uint8 class index per pixel in landcover.npy, expanded when loaded
+LAYOUTS = [LAYOUT_ONEHOT, LAYOUT_INDEX]
+
+# The dtypes process_chips can store the scaled images in. The unsigned
+# ones quantize the [0, 1] values to evenly spaced levels (see quantize).
+PRECISION_FLOAT64 = "float64"
+PRECISIONS = [PRECISION_FLOAT64, "float32", "float16", "uint16", "uint8"]
+
+IMAGES_FILE_NAME = "images.npy"
+MASKS_FILE_NAME = "masks.npy"
+LANDCOVER_FILE_NAME = "landcover.npy"
+METADATA_FILE_NAME = "metadata.json"
+
+
+def open_processed(directory):
+    """
+    Open a local copy of a processed_data directory written by
+    process_chips. Returns its metadata and its arrays by file name
+    (images, masks and, with the index layout, landcover), memory-mapped so
+    chips are only read from disk as they are used.
+
+    Data processed before the metadata was written has the one-hot layout.
+    """
+    metadata = {"layout": LAYOUT_ONEHOT}
+    metadata_path = os.path.join(directory, METADATA_FILE_NAME)
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+
+    names = [IMAGES_FILE_NAME, MASKS_FILE_NAME]
+    if metadata["layout"] == LAYOUT_INDEX:
+        names.append(LANDCOVER_FILE_NAME)
+    arrays = {
+        name[:-len(".npy")]: np.load(os.path.join(directory, name), mmap_mode="r")
+        for name in names
+    }
+    return metadata, arrays
+
+
+def precision_metadata(precision):
+    """
+    The metadata of images stored in precision: its dtype and, for the
+    quantized ones, the scale and offset that map stored levels back to
+    [0, 1] values, and the level that stands for NaN.
+    """
+    dtype = np.dtype(precision)
+    if dtype.kind != "u":
+        return {"dtype": dtype.name}
+    nodata = int(np.iinfo(dtype).max)
+    return {"dtype": dtype.name, "scale": 1 / (nodata - 1), "offset": 0.0, "nodata": nodata}
+
+
+def quantize(values, metadata):
+    """
+    Convert values scaled to [0, 1] to the dtype of metadata (see
+    precision_metadata), rounding them to the nearest level if it is
+    quantized. NaNs are stored as its nodata level.
+    """
+    dtype = np.dtype(metadata["dtype"])
+    if "scale" not in metadata:
+        return np.asarray(values, dtype=dtype)
+    levels = np.rint((np.clip(values, 0, 1) - metadata["offset"]) / metadata["scale"])
+    levels[np.isnan(levels)] = metadata["nodata"]
+    return levels.astype(dtype)
+
+
+def dequantize(stored, metadata, dtype=np.float32):
+    """Stored images as [0, 1] values of dtype, with NaN for the nodata level, if they are quantized."""
+    if "scale" not in metadata:
+        return np.asarray(stored)
+    values = stored.astype(dtype) * dtype(metadata["scale"]) + dtype(metadata["offset"])
+    values[stored == metadata["nodata"]] = np.nan
+    return values
+
+
+def one_hot(landcover, num_classes, dtype=np.float32):
+    """
+    Expand class indexes of shape (N, 1, H, W), i + 1 for the i-th class
+    and 0 for none, to one-hot channels of shape (N, num_classes, H, W).
+    """
+    # Row 0 of the table, for pixels without a class, is all zeros
+    table = np.eye(num_classes + 1, dtype=dtype)[:, 1:]
+    return np.ascontiguousarray(np.moveaxis(table[landcover[:, 0]], -1, 1))
+
+
+def iter_batches(directory, batch_size=32, landcover=LAYOUT_ONEHOT, dequantized=True):
+    """
+    Yield batches of processed chips from a local processed_data directory,
+    reading only one batch at a time. Quantized images are converted back to
+    float32 values unless dequantized is False.
+
+    With landcover "onehot", batches are (images, masks), with the one-hot
+    landcover channels after the scaled bands whatever the layout on disk:
+    data with the index layout is expanded a batch at a time. With
+    landcover "index", batches are (images, landcover, masks) with the
+    class indexes kept apart, e.g. to feed an embedding; this needs data
+    written with the index layout.
+    """
+    metadata, arrays = open_processed(directory)
+    images, masks = arrays["images"], arrays["masks"]
+    if landcover == LAYOUT_INDEX and metadata["layout"] != LAYOUT_INDEX:
+        raise ValueError(f"{directory} has no landcover indexes, its layout is '{metadata['layout']}'")
+
+    for start in range(0, len(images), batch_size):
+        batch = slice(start, start + batch_size)
+        batch_images = images[batch]
+        if dequantized:
+            batch_images = dequantize(batch_images, metadata)
+        if metadata["layout"] == LAYOUT_ONEHOT:
+            yield np.asarray(batch_images), np.asarray(masks[batch])
+        elif landcover == LAYOUT_INDEX:
+            yield np.asarray(batch_images), np.asarray(arrays["landcover"][batch]), np.asarray(masks[batch])
+        else:
+            encoded = one_hot(arrays["landcover"][batch], len(metadata["landcover_classes"]))
+            if not dequantized:
+                encoded = quantize(encoded, metadata)
+            yield np.concatenate([batch_images, encoded.astype(batch_images.dtype, copy=False)], axis=1), np.asarray(masks[batch])
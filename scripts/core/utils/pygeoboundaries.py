@@ -1,11 +1,12 @@
+from functools import lru_cache
 from typing import List, Union
 import geojson
 import requests
-from requests_cache import CachedSession
-from utils import countries_iso_dict
 from utils import iso_codes
-from fuzzywuzzy import process
-import ee
+
+# requests_cache, Earth Engine, fuzzywuzzy and the multilingual country name
+# table (4,000+ entries) are imported on first use, since most runs pass
+# ISO3 codes and never need the name lookup.
 
 
 class SessionManager:
@@ -14,6 +15,8 @@ class SessionManager:
 
     def get_session(self):
         if self._session is None:
+            from requests_cache import CachedSession
+
             self._session = CachedSession(expire_after=604800)  # Default to 1 week
         return self._session
 
@@ -22,6 +25,8 @@ class SessionManager:
             self._session.cache.clear()
 
     def set_cache_expire_time(self, seconds: int):
+        from requests_cache import CachedSession
+
         self._session = CachedSession(expire_after=seconds)
 
     def disable_cache(self):
@@ -32,12 +37,19 @@ class SessionManager:
 session_manager = SessionManager()
 
 
-def _is_valid_adm(iso3, adm: str) -> bool:
+# The index and metadata lookups below are memoized for the life of the
+# process, so a batch run resolves each country once however often it asks
+
+@lru_cache(maxsize=None)
+def _adm_index(iso3) -> str:
     session = session_manager.get_session()
-    html = session.get(
+    return session.get(
         f"https://www.geoboundaries.org/api/current/gbOpen/{iso3}/", verify=True
     ).text
-    return adm in html
+
+
+def _is_valid_adm(iso3, adm: str) -> bool:
+    return adm in _adm_index(iso3)
 
 
 def _validate_adm(adm: Union[str, int]) -> str:
@@ -63,6 +75,9 @@ def _is_valid_iso3_code(territory: str) -> bool:
 
 
 def _get_iso3_from_name_or_iso2(name: str) -> str:
+    from fuzzywuzzy import process
+    from utils import countries_iso_dict
+
     name_lower = str.lower(name)
 
     # Try to get a direct match first
@@ -101,6 +116,7 @@ def _generate_url(territory: str, adm: Union[str, int]) -> str:
     return f"https://www.geoboundaries.org/api/current/gbOpen/{iso3}/{adm}/"
 
 
+@lru_cache(maxsize=None)
 def get_metadata(territory: str, adm: Union[str, int]) -> dict:
     session = session_manager.get_session()
     url = _generate_url(territory, adm)
@@ -144,6 +160,8 @@ def get_adm(
 def get_adm_ee(
     territories: Union[str, List[str]], adm: Union[str, int], simplified=True
 ):
+    import ee
+
     # Use the original get_adm function to get the GeoJSON FeatureCollection
     geojson_feature_collection = get_adm(territories, adm, simplified)
 
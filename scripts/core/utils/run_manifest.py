@@ -0,0 +1,109 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DONE = "done"
+EMPTY = "empty"  # Finished, but produced nothing (e.g. no imagery for an event)
+FAILED = "failed"
+
+
+def fingerprint(*parts):
+    """
+    Build a short, stable fingerprint from the inputs of a stage.
+
+    Parameters:
+    - parts: Any JSON-serialisable values (dates and other objects are
+      converted with str)
+
+    Returns:
+    - A hex digest identifying the inputs
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class RunManifest:
+    """
+    Local SQLite record of which pipeline stages have finished, per country
+    and per flood event, together with a fingerprint of the inputs each stage
+    ran on. A rerun skips every stage whose inputs are unchanged and resumes at
+    the first one that is missing or failed.
+
+    Country-level records use an empty event key.
+    """
+
+    def __init__(self, path="run_manifest.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stages (
+                    country TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    event TEXT NOT NULL DEFAULT '',
+                    fingerprint TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (country, stage, event)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call keeps the manifest safe to share
+        # between the scheduler's worker threads
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, country, stage, event=""):
+        """Return (fingerprint, status) of a recorded stage, or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT fingerprint, status FROM stages WHERE country = ? AND stage = ? AND event = ?",
+                (country, stage, event),
+            ).fetchone()
+        return row
+
+    def is_done(self, country, stage, fingerprint, event=""):
+        """Whether the stage finished (done or empty) on the same inputs."""
+        row = self.get(country, stage, event)
+        return row is not None and row[0] == fingerprint and row[1] in (DONE, EMPTY)
+
+    def record(self, country, stage, fingerprint, status=DONE, event=""):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)",
+                (country, stage, event, fingerprint, status, time.time()),
+            )
+
+    def has_failures(self, country, stage):
+        """
+        Whether any event of the stage is currently recorded as failed. The
+        country-level record is left out: it marks a failed run of the whole
+        stage, which the next successful run replaces.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM stages WHERE country = ? AND stage = ? AND status = ? AND event != ''",
+                (country, stage, FAILED),
+            ).fetchone()
+        return row[0] > 0
+
+    def forget(self, country, stage):
+        """Forget the records of one stage of a country, e.g. once its output is overwritten."""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM stages WHERE country = ? AND stage = ?", (country, stage))
+
+    def clear(self, country):
+        """Forget every record of a country so that it runs from scratch."""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM stages WHERE country = ?", (country,))
@@ -0,0 +1,184 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Measurement:
+    """Counters a timed step can add to while it runs."""
+
+    def __init__(self, items=0, nbytes=0):
+        self.items = items
+        self.bytes = nbytes
+
+
+class RunReport:
+    """
+    Collects timing, item and byte counts per (country, stage, step) for a
+    run, and writes them out as a JSON or CSV report with throughput figures.
+
+    Totals are accumulated as they come in rather than stored per call, so
+    timing every chip costs a dict update, not a growing list. The country and
+    stage are taken from the scope set by the calling thread (see scope()),
+    so the pipeline functions only need to name their step.
+
+    Figures that aren't timings, like the size and error of the processed
+    output, are recorded as notes (see note()) and written with the JSON
+    report, or next to a CSV one (see write()).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._totals = {}
+        self._notes = []
+        self.started_at = time.time()
+
+    @contextmanager
+    def scope(self, country, stage):
+        """Attribute everything recorded by this thread to a country and stage."""
+        previous = getattr(self._local, "scope", None)
+        self._local.scope = (country, stage)
+        try:
+            yield
+        finally:
+            self._local.scope = previous
+
+    def current_scope(self):
+        return getattr(self._local, "scope", None) or ("", "")
+
+    def add(self, step, seconds, items=0, nbytes=0):
+        key = (*self.current_scope(), step)
+        with self._lock:
+            totals = self._totals.setdefault(key, [0, 0.0, 0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += items
+            totals[3] += nbytes
+
+    def note(self, step, **values):
+        """Record figures about a step in the current scope, e.g. the trade-offs of a setting it used."""
+        country, stage = self.current_scope()
+        with self._lock:
+            self._notes.append(dict({"country": country, "stage": stage, "step": step}, **values))
+
+    @contextmanager
+    def timer(self, step, items=0, nbytes=0):
+        """
+        Time a block of code as one call of a step. The yielded Measurement's
+        items and bytes can be increased inside the block.
+        """
+        measurement = Measurement(items, nbytes)
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            self.add(step, time.perf_counter() - start, measurement.items, measurement.bytes)
+
+    def drain(self):
+        """Return and reset the totals, e.g. to send them back from a worker process."""
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        return totals
+
+    def merge(self, totals):
+        """Add totals drained from another RunReport (typically a worker process)."""
+        with self._lock:
+            for key, (calls, seconds, items, nbytes) in totals.items():
+                current = self._totals.setdefault(key, [0, 0.0, 0, 0])
+                current[0] += calls
+                current[1] += seconds
+                current[2] += items
+                current[3] += nbytes
+
+    def rows(self):
+        with self._lock:
+            totals = dict(self._totals)
+        return [
+            _row({"country": country, "stage": stage, "step": step}, *values)
+            for (country, stage, step), values in sorted(totals.items())
+        ]
+
+    def _grouped(self, rows, key):
+        groups = {}
+        for row in rows:
+            group = groups.setdefault(row[key], [0, 0.0, 0, 0])
+            group[0] += row["calls"]
+            group[1] += row["seconds"]
+            group[2] += row["items"]
+            group[3] += row["bytes"]
+        return [_row({key: name}, *values) for name, values in sorted(groups.items())]
+
+    def write(self, path):
+        """
+        Write the report as CSV if path ends in .csv, otherwise as JSON. The
+        notes of a CSV report go to a second file, <name>_notes.csv, as
+        their fields differ from the step rows'.
+        """
+        rows = self.rows()
+        with self._lock:
+            notes = list(self._notes)
+        if path.endswith(".csv"):
+            _write_csv(path, rows)
+            if notes:
+                _write_csv(notes_path(path), notes)
+            return
+
+        # Step rows are the source of truth; the groupings sum step times, so
+        # overlapping steps (e.g. a stage's "total" and its parts) add up
+        finished_at = time.time()
+        report = {
+            "started_at": self.started_at,
+            "finished_at": finished_at,
+            "wall_seconds": finished_at - self.started_at,
+            "steps": rows,
+            "by_stage_step": self._grouped(
+                [dict(row, stage_step=f"{row['stage']}/{row['step']}") for row in rows],
+                "stage_step",
+            ),
+            "by_country": self._grouped(
+                [row for row in rows if row["step"] == "total"], "country"
+            ),
+            "notes": notes,
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def print_summary(self):
+        for row in self.rows():
+            if row["step"] == "total":
+                print(f"{row['country']} {row['stage']}: {row['seconds']:.1f} s")
+
+
+def notes_path(path):
+    """Where the notes of a CSV report at path are written."""
+    return f"{path[:-len('.csv')]}_notes.csv"
+
+
+def _write_csv(path, rows):
+    # Every field of any row gets a column, in the order first seen
+    fieldnames = list(dict.fromkeys(field for row in rows for field in row)) or ["country"]
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _row(labels, calls, seconds, items, nbytes):
+    row = dict(labels)
+    row.update(
+        {
+            "calls": calls,
+            "seconds": round(seconds, 6),
+            "items": items,
+            "bytes": nbytes,
+            "items_per_s": round(items / seconds, 3) if seconds > 0 else None,
+            "mb_per_s": round(nbytes / 1e6 / seconds, 3) if seconds > 0 else None,
+        }
+    )
+    return row
+
+
+# Process-wide report; worker processes drain theirs and send it back
+report = RunReport()
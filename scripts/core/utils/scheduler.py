@@ -0,0 +1,135 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Stage:
+    """
+    A single step of the per-country pipeline.
+
+    Parameters:
+    - name: Unique name of the stage (e.g. "export")
+    - func: Callable taking the item (country name) that runs the stage
+    - pool: Name of the worker pool the stage is submitted to
+    - requires: Names of the stages that must finish first. Defaults to the
+      previous stage in the pipeline, which gives a simple chain.
+    """
+
+    def __init__(self, name, func, pool, requires=None):
+        self.name = name
+        self.func = func
+        self.pool = pool
+        self.requires = requires
+
+
+class StagePipeline:
+    """
+    Runs every item through a small DAG of stages, with a separate worker pool
+    per kind of work. An item moves on to its next stage as soon as the stages
+    it depends on have finished, so different items overlap: one country can be
+    chipping while another is still waiting on its Earth Engine exports.
+
+    Parameters:
+    - stages: List of Stage objects, in pipeline order
+    - pool_sizes: Dict mapping each pool name to its number of workers
+    """
+
+    def __init__(self, stages, pool_sizes):
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError("Stage names must be unique.")
+
+        self.stages = []
+        for index, stage in enumerate(stages):
+            if stage.requires is None:
+                stage.requires = [names[index - 1]] if index > 0 else []
+            unknown = set(stage.requires) - set(names[:index])
+            if unknown:
+                raise ValueError(
+                    f"Stage '{stage.name}' requires unknown or later stages: {sorted(unknown)}"
+                )
+            if stage.pool not in pool_sizes:
+                raise ValueError(f"No pool size given for pool '{stage.pool}'")
+            self.stages.append(stage)
+
+        self.pool_sizes = pool_sizes
+
+    def run(self, items):
+        """
+        Run all stages for all items and block until every item has either
+        finished or failed.
+
+        Returns:
+        - A dict mapping each item to the exception that stopped it, or None
+          if all of its stages completed
+        """
+        items = list(dict.fromkeys(items))
+        errors = {item: None for item in items}
+        if not items:
+            return errors
+
+        # Re-entrant because a callback fires inline when its future is already done
+        lock = threading.RLock()
+        all_done = threading.Event()
+        completed = {item: set() for item in items}
+        submitted = {item: set() for item in items}
+        in_flight = {item: 0 for item in items}
+        finished = set()
+
+        pools = {
+            name: ThreadPoolExecutor(max_workers=size, thread_name_prefix=name)
+            for name, size in self.pool_sizes.items()
+        }
+
+        def finish(item):
+            # Caller holds the lock
+            finished.add(item)
+            if len(finished) == len(items):
+                all_done.set()
+
+        def submit_ready(item):
+            # Caller holds the lock
+            ready = [
+                stage
+                for stage in self.stages
+                if stage.name not in submitted[item]
+                and all(name in completed[item] for name in stage.requires)
+            ]
+            for stage in ready:
+                if stage.name in submitted[item] or errors[item] is not None:
+                    continue
+                submitted[item].add(stage.name)
+                in_flight[item] += 1
+                future = pools[stage.pool].submit(stage.func, item)
+                future.add_done_callback(
+                    lambda future, item=item, stage=stage: on_done(item, stage, future)
+                )
+
+        def on_done(item, stage, future):
+            error = future.exception()
+            with lock:
+                in_flight[item] -= 1
+                if error is not None:
+                    if errors[item] is None:
+                        errors[item] = error
+                        print(
+                            f"An error occurred processing {item} during stage '{stage.name}': {error}"
+                        )
+                else:
+                    completed[item].add(stage.name)
+                    if errors[item] is None:
+                        submit_ready(item)
+
+                if in_flight[item] == 0 and item not in finished:
+                    # Either everything ran or a failure stopped the item
+                    finish(item)
+
+        try:
+            with lock:
+                for item in items:
+                    submit_ready(item)
+            all_done.wait()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+
+        return errors
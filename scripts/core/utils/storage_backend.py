@@ -0,0 +1,250 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+GCS = "gcs"
+LOCAL = "local"
+BACKENDS = [GCS, LOCAL]
+
+# Read from the environment so spawned worker processes use the same setting
+HTTP_POOL_SIZE_ENV = "GCS_HTTP_POOL_SIZE"
+DEFAULT_HTTP_POOL_SIZE = 32
+BLOCK_CACHE_ENV = "RASTER_BLOCK_CACHE_MB"
+DEFAULT_BLOCK_CACHE_MB = 256
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure_client(http_pool_size):
+    """
+    Set the HTTP connection pool size of the shared client. Must be called
+    before the client is first used; worker processes inherit the setting.
+    """
+    if _client is not None:
+        print("Storage client already created; the new pool size only applies to new processes.")
+    os.environ[HTTP_POOL_SIZE_ENV] = str(http_pool_size)
+
+
+def configure_block_cache(megabytes):
+    """
+    Set the size of GDAL's raster block cache used by open_raster. Worker
+    processes inherit the setting.
+    """
+    os.environ[BLOCK_CACHE_ENV] = str(megabytes)
+
+
+def block_cache_bytes():
+    """The size of GDAL's raster block cache used by open_raster, in bytes."""
+    return int(os.getenv(BLOCK_CACHE_ENV, DEFAULT_BLOCK_CACHE_MB)) * 1024 * 1024
+
+
+def get_client():
+    """
+    Returns the process-wide google.cloud.storage client, creating it on first
+    use. All stages share it, so credentials are resolved and refreshed once
+    and connections are kept alive and reused. Its HTTP pool holds
+    GCS_HTTP_POOL_SIZE connections (default 32) per host rather than
+    urllib3's default of 10, so many concurrent transfers don't discard
+    connections with "connection pool is full" warnings.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _build_client()
+    return _client
+
+
+def _build_client():
+    import google.auth
+    import requests
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import storage
+
+    pool_size = int(os.getenv(HTTP_POOL_SIZE_ENV, DEFAULT_HTTP_POOL_SIZE))
+    credentials, default_project = google.auth.default(
+        scopes=["https://www.googleapis.com/auth/devstorage.full_control"]
+    )
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    project = os.getenv("GOOGLE_CLOUD_PROJECT_NAME") or default_project
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+class LocalBlob:
+    """
+    A file under a LocalBucket, exposing the subset of the
+    google.cloud.storage.Blob interface used by the pipeline.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.path, *self.name.split("/"))
+
+    @property
+    def generation(self):
+        # Changes whenever the file is rewritten, like a GCS generation
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @property
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def download_as_bytes(self, start=None, end=None):
+        # Byte ranges are inclusive on both ends, as in the GCS API
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                start = 0 if start is None else start
+                stop = len(mapped) if end is None else end + 1
+                return mapped[start:stop]
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def _write(self, write):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial object
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def upload_from_string(self, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._write(lambda f: f.write(data))
+
+    def upload_from_filename(self, filename, content_type=None):
+        def copy(f):
+            with open(filename, "rb") as source:
+                shutil.copyfileobj(source, f, length=16 * 1024 * 1024)
+
+        self._write(copy)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class LocalBucket:
+    """
+    A directory on local disk standing in for a GCS bucket, so the chip
+    stages can run against a local staging copy, or with no network at all.
+    Objects live at <root>/<bucket name>/<object name>.
+    """
+
+    def __init__(self, root, name):
+        self.root = root
+        self.name = name
+
+    @property
+    def path(self):
+        return os.path.join(self.root, self.name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = LocalBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=None):
+        prefix = prefix or ""
+        names = []
+        # Only the directory the prefix ends in can hold matching objects; if
+        # it doesn't exist, nothing matches and the walk yields nothing
+        top = os.path.join(self.path, *prefix.split("/")[:-1])
+        for dirpath, _, filenames in os.walk(top):
+            relative_dir = os.path.relpath(dirpath, self.path)
+            for filename in filenames:
+                if filename.endswith(".part"):
+                    continue
+                name = filename if relative_dir == "." else f"{relative_dir}/{filename}"
+                name = name.replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        # GCS lists objects in lexicographic order
+        return [LocalBlob(self, name) for name in sorted(names)]
+
+
+def get_bucket(bucket_name, backend=GCS, local_root=None):
+    """
+    Returns the bucket the pipeline reads from and writes to.
+
+    Parameters:
+    - bucket_name: Name of the GCS bucket (also the directory name locally)
+    - backend: "gcs" or "local"
+    - local_root: Directory holding local buckets, required for "local"
+    """
+    if backend == LOCAL:
+        if not local_root:
+            raise ValueError("A local root directory is required for the local backend.")
+        return LocalBucket(local_root, bucket_name)
+    if backend == GCS:
+        return get_client().get_bucket(bucket_name)
+    raise ValueError(f"Unknown storage backend '{backend}', expected one of {BACKENDS}")
+
+
+def to_worker_ref(bucket):
+    """
+    A picklable reference to a bucket for worker processes: GCS buckets
+    hold a client, so only their name is sent.
+    """
+    return bucket if isinstance(bucket, LocalBucket) else bucket.name
+
+
+def from_worker_ref(ref):
+    return ref if isinstance(ref, LocalBucket) else get_client().bucket(ref)
+
+
+@contextmanager
+def open_raster(blob):
+    """
+    Open a raster object with rasterio without copying it into memory.
+
+    Local files are opened in place. GCS objects are opened through GDAL's
+    /vsigs/ driver, which fetches only the byte ranges of the blocks that
+    are read; the exports are cloud-optimised GeoTIFFs, so a window maps to
+    a few contiguous ranges. GDAL authenticates with the key file in
+    GOOGLE_APPLICATION_CREDENTIALS. Decoded blocks are kept in a cache of
+    RASTER_BLOCK_CACHE_MB megabytes (default 256), so memory use depends on
+    the windows being read rather than on the size of the raster.
+    """
+    import rasterio
+
+    with rasterio.Env(
+        GDAL_CACHEMAX=block_cache_bytes() // (1024 * 1024),
+        GDAL_HTTP_MERGE_CONSECUTIVE_RANGES="YES",
+        GDAL_HTTP_MULTIPLEX="YES",
+    ):
+        if isinstance(blob, LocalBlob):
+            path = blob.path
+        else:
+            path = f"/vsigs/{blob.bucket.name}/{blob.name}"
+        with rasterio.open(path) as src:
+            yield src
@@ -0,0 +1,115 @@
+import json
+import os
+import posixpath
+
+# What happens to tiles that would run past the right or bottom edge
+EDGE_PAD = "pad"  # Keep them, zero-padded to full size
+EDGE_DROP = "drop"  # Leave them out
+EDGE_SHIFT = "shift"  # Move them inward so they end at the edge
+EDGE_POLICIES = [EDGE_PAD, EDGE_DROP, EDGE_SHIFT]
+
+PLAN_FILE_NAME = "tile_plan.json"
+
+
+class TilePlan:
+    """
+    How a raster is cut into chips: square tiles of `size` pixels placed
+    every `stride` pixels (less than size for overlapping tiles), what to do
+    at the edges, and the dtype chips are stored in (None keeps the raster's).
+
+    The plan is written next to the chips (see save_plan), so downstream
+    stages check chips against it rather than assuming a shape, and chips
+    for another model input size can be made with a new plan alongside the
+    existing ones.
+    """
+
+    def __init__(self, size=512, stride=None, edge=EDGE_PAD, dtype=None):
+        if edge not in EDGE_POLICIES:
+            raise ValueError(f"Unknown edge policy '{edge}', expected one of {EDGE_POLICIES}")
+        stride = stride or size
+        if not 0 < stride <= size:
+            raise ValueError(f"The stride must be between 1 and the tile size ({size}), got {stride}")
+        self.size = size
+        self.stride = stride
+        self.edge = edge
+        self.dtype = dtype
+
+    def to_dict(self):
+        return {"size": self.size, "stride": self.stride, "edge": self.edge, "dtype": self.dtype}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def __eq__(self, other):
+        return isinstance(other, TilePlan) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"TilePlan({self.to_dict()})"
+
+    @property
+    def name(self):
+        """Short label for the plan, e.g. to name the directory its chips go to."""
+        name = f"tiles{self.size}"
+        if self.stride != self.size:
+            name += f"_stride{self.stride}"
+        if self.edge != EDGE_PAD:
+            name += f"_{self.edge}"
+        if self.dtype:
+            name += f"_{self.dtype}"
+        return name
+
+    def offsets(self, length):
+        """Offsets of the tiles along an axis of `length` pixels."""
+        offsets = []
+        offset = 0
+        while offset < length:
+            if offset + self.size > length:
+                if self.edge == EDGE_DROP:
+                    break
+                if self.edge == EDGE_SHIFT:
+                    # Rasters smaller than a tile still get one, padded
+                    offset = max(0, length - self.size)
+            if not offsets or offset > offsets[-1]:
+                offsets.append(offset)
+            if offset + self.size >= length:
+                break
+            offset += self.stride
+        return offsets
+
+    def windows(self, width, height):
+        """(col_off, row_off, width, height) of every tile, in row-major order."""
+        return [
+            (col_off, row_off, min(self.size, width - col_off), min(self.size, height - row_off))
+            for row_off in self.offsets(height)
+            for col_off in self.offsets(width)
+        ]
+
+
+DEFAULT_PLAN = TilePlan()
+
+
+def plan_prefix(path_prefix, plan):
+    """
+    Where the data made with a plan goes: .../chips/<country> for the
+    default plan, .../chips/<plan name>/<country> for any other, so a
+    listing of one never picks up the other.
+    """
+    if plan == DEFAULT_PLAN:
+        return path_prefix
+    parent, name = posixpath.split(path_prefix)
+    return posixpath.join(parent, plan.name, name)
+
+
+def save_plan(bucket, path_prefix, plan):
+    bucket.blob(os.path.join(path_prefix, PLAN_FILE_NAME)).upload_from_string(
+        json.dumps(plan.to_dict()), content_type="application/json"
+    )
+
+
+def load_plan(bucket, path_prefix):
+    """The plan the chips under path_prefix were made with; chips made before plans existed used the default."""
+    blob = bucket.get_blob(os.path.join(path_prefix, PLAN_FILE_NAME))
+    if blob is None:
+        return DEFAULT_PLAN
+    return TilePlan.from_dict(json.loads(blob.download_as_bytes()))
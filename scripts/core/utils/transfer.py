@@ -0,0 +1,125 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from utils.run_report import report
+
+# Read from the environment so spawned worker processes use the same setting
+CONCURRENCY_ENV = "TRANSFER_CONCURRENCY"
+DEFAULT_CONCURRENCY = 32
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+class TransferEngine:
+    """
+    Keeps many small object transfers in flight while the caller carries on
+    decoding and encoding chips.
+
+    An asyncio event loop runs in a background thread and admits at most
+    `concurrency` transfers at a time through a semaphore. The storage client
+    has no asyncio API, so each admitted request runs in the loop's thread
+    pool. Callers get concurrent.futures.Future objects back. submit() blocks
+    once `max_pending` transfers are queued or running, which bounds the
+    memory held by tiles waiting to be uploaded.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, max_pending=None):
+        self.concurrency = concurrency
+        self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="transfer")
+        self._loop.set_default_executor(self._executor)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = threading.BoundedSemaphore(max_pending or 4 * concurrency)
+        self._thread = threading.Thread(target=self._loop.run_forever, name="transfer-loop", daemon=True)
+        self._thread.start()
+
+    async def _run(self, func, scope):
+        async with self._semaphore:
+            return await self._loop.run_in_executor(None, partial(_run_in_scope, func, scope))
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule a blocking transfer call; returns a concurrent.futures.Future."""
+        self._pending.acquire()
+        # Timings recorded by the transfer belong to the submitting stage
+        scope = report.current_scope()
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(partial(func, *args, **kwargs), scope), self._loop
+        )
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def upload(self, blob, data, content_type=None):
+        return self.submit(_upload, blob, data, content_type)
+
+    def download_many(self, blobs, prefetch=None):
+        """
+        Yield (blob, bytes) for every blob, in order, keeping up to `prefetch`
+        downloads (default: the engine's concurrency) running ahead of the
+        consumer.
+        """
+        prefetch = prefetch or self.concurrency
+        blobs = iter(blobs)
+        window = deque()
+        for blob in blobs:
+            window.append((blob, self.submit(_download, blob)))
+            if len(window) >= prefetch:
+                break
+        while window:
+            blob, future = window.popleft()
+            next_blob = next(blobs, None)
+            if next_blob is not None:
+                window.append((next_blob, self.submit(_download, next_blob)))
+            yield blob, future.result()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self._loop.close()
+
+
+def _run_in_scope(func, scope):
+    with report.scope(*scope):
+        return func()
+
+
+def _upload(blob, data, content_type):
+    with report.timer("upload", items=1, nbytes=len(data)):
+        blob.upload_from_string(data, content_type=content_type)
+
+
+def _download(blob):
+    with report.timer("download", items=1) as step:
+        data = blob.download_as_bytes()
+        step.bytes += len(data)
+    return data
+
+
+def wait_all(futures):
+    """Wait for transfers to finish and re-raise the first error."""
+    for future in futures:
+        future.result()
+
+
+def configure_transfers(concurrency):
+    """
+    Set how many transfers the shared engine keeps in flight. Must be called
+    before the engine is first used; worker processes inherit the setting.
+    """
+    os.environ[CONCURRENCY_ENV] = str(concurrency)
+
+
+def get_engine():
+    """Returns the process-wide TransferEngine, creating it on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                concurrency = int(os.getenv(CONCURRENCY_ENV, DEFAULT_CONCURRENCY))
+                _engine = TransferEngine(concurrency)
+    return _engine